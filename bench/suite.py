@@ -0,0 +1,285 @@
+#!/bin/env python
+"""
+ Benchmark yamp's hot paths with generated workloads, report the wall time, peak memory and
+ operations per second of each, save the results as JSON and compare them with a baseline.
+
+ Each workload is run in its own forked process, so the peak resident set size is its own.
+ The time is the best of the repeats. Parsed files are forgotten between repeats, the
+ template and compiled body caches are not.
+
+ Usage:
+
+      python2 bench/suite.py [--scale F] [--repeats N] [--only NAME,..] [--output FILE]
+                             [--baseline FILE] [--save-baseline] [--time-threshold PCT] [--rss-threshold PCT]
+                             [--engine recursive|stack]
+
+ The exit status is 1 if any workload is slower, or uses more memory, than the baseline by more
+ than the threshold percentage. A baseline measured with another engine or Python version is not
+ compared, and the exit status is 1.
+"""
+from __future__ import print_function
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import platform
+
+curr_path = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(curr_path + '/../src')
+
+import yamp
+
+
+def recursion(size):
+    """
+    Macro recursion to depth 50, as in examples/recursive.yaml.
+    """
+    calls = size // 50
+    text = '''
+- defmacro:
+    name: loop
+    args: [depth]
+    value:
+      if: {'==': [depth, 50]}
+      then: null
+      else:
+          new: {loop: {depth: {'+': [depth, 1]}}}
+          to: [depth, axe]
+---
+- repeat: {for: i, in: {range: [1, %d]}, body: {loop: {depth: 0}}}
+''' % calls
+    return {'main.yaml': text}, calls * 50
+
+
+def macro_loop(size):
+    """
+    A macro with an 'if' in its body, called in two nested repeats.
+    """
+    text = '''
+- defmacro:
+    name: server
+    args: [i, j]
+    value:
+      name: "srv-{{i}}-{{j}}"
+      port: {'+': [8000, j]}
+      tags: [web, "zone{{j}}", site]
+      primary: {if: {'==': [j, 1]}, then: yes, else: no}
+- define: {site: north}
+- repeat: {for: i, in: {range: [1, %d]}, body: {repeat: {for: j, in: {range: [1, 10]}, body: {server: {i: i, j: j}}}}}
+''' % (size // 10)
+    return {'main.yaml': text}, size // 10 * 10
+
+
+def repeat_range(size):
+    text = '- repeat: {for: i, in: {range: [1, %d]}, body: {host: "web-{{i}}", port: i}}\n' % size
+    return {'main.yaml': text}, size
+
+
+def interpolation(size):
+    text = '''- define: {site: {name: example, zone: {id: 7, region: north}}, user: admin}
+- repeat:
+    for: i
+    in: {range: [1, %d]}
+    body: "{{user}}@{{site.name}}.{{site.zone.region}}-{{site.zone.id}}/{{i}}/{{user}}"
+''' % size
+    return {'main.yaml': text}, size * 5
+
+
+def load_json(size):
+    records = [{'name': 'host{}'.format(i), 'ip': '10.0.{}.{}'.format(i // 256, i % 256),
+                'tags': ['web', 'zone{}'.format(i % 3)], 'port': 8000 + i} for i in range(size)]
+    text = '- define: {hosts: {load: hosts.json}}\n- "{{hosts.0.name}} {{hosts.%d.ip}}"\n' % (size - 1)
+    return {'main.yaml': text, 'hosts.json': json.dumps(records)}, size
+
+
+def multi_document(size):
+    documents = ['- define: {env: prod, owner: ops}\n']
+    documents += ['- {name: "service%d-{{env}}", owner: owner, replicas: %d}\n' % (i, i % 5) for i in range(size)]
+    return {'main.yaml': '---\n'.join(documents)}, size
+
+
+def merge_flatten(size):
+    text = '''- define:
+    lists: {repeat: {for: i, in: {range: [1, %d]}, body: [[i, i], [i]]}}
+    maps: {repeat: {for: i, in: {range: [1, %d]}, body: {key: "k{{i}}", value: i}}}
+- flatten: lists
+- merge: {repeat: {for: m, in: maps, body: {"{{m.key}}": m.value}}}
+''' % (size, size)
+    return {'main.yaml': text}, size * 2
+
+
+def python_eval(size):
+    text = '- repeat: {for: i, in: {range: [1, %d]}, body: {python_eval: "i * 2 + len(str(i))"}}\n' % size
+    return {'main.yaml': text}, size
+
+
+WORKLOADS = [
+    ('recursion', recursion, 2500),
+    ('macro_loop', macro_loop, 10000),
+    ('repeat_range', repeat_range, 20000),
+    ('interpolation', interpolation, 10000),
+    ('load_json', load_json, 20000),
+    ('multi_document', multi_document, 5000),
+    ('merge_flatten', merge_flatten, 5000),
+    ('python_eval', python_eval, 20000),
+]
+
+
+class NullFile(object):
+    """
+    Output file which only counts what is written.
+    """
+    def __init__(self):
+        self.size = 0
+
+    def write(self, text):
+        self.size += len(text)
+
+    def flush(self):
+        pass
+
+
+def expand_once(path):
+    yamp.parse_cache = yamp.LRUCache(yamp.PARSE_CACHE_BUDGET)
+    output = NullFile()
+    start = time.time()
+    yamp.expand_file(path, yamp.new_globals(['yamp', path]), expandafterload=True, outputfile=output)
+    return time.time() - start, output.size
+
+
+def run_workload(workload, size, repeats):
+    """
+    Run a workload in a forked process.
+    :return: {'time': best seconds, 'ops': operations, 'ops_per_sec': .., 'rss_kb': peak resident set, 'output_bytes': ..}
+    """
+    directory = tempfile.mkdtemp()
+    try:
+        files, ops = workload(size)
+        for name, text in files.items():
+            with open(os.path.join(directory, name), 'w') as fd:
+                fd.write(text)
+        path = os.path.join(directory, 'main.yaml')
+        reader, writer = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(reader)
+            try:
+                times = [expand_once(path) for _ in range(repeats)]
+                result = {'time': min(t for t, _ in times), 'output_bytes': times[0][1]}
+            except (Exception, SystemExit) as e:
+                result = {'error': '{}: {}'.format(type(e).__name__, e)}
+            os.write(writer, json.dumps(result))
+            os._exit(0)
+        os.close(writer)
+        chunks = []
+        while True:
+            chunk = os.read(reader, 65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        os.close(reader)
+        _, _, usage = os.wait4(pid, 0)
+        result = json.loads(''.join(chunks) or '{"error": "no result"}')
+        result['rss_kb'] = usage.ru_maxrss
+        if 'time' in result:
+            result['ops'] = ops
+            result['ops_per_sec'] = ops / result['time'] if result['time'] else None
+        return result
+    finally:
+        shutil.rmtree(directory)
+
+
+def mismatch(report, baseline):
+    """
+    :return: how the baseline was measured differently, with another engine or Python version, or None
+    """
+    differences = ['{} {} rather than {}'.format(key, baseline.get(key), report[key])
+                   for key in ('engine', 'python') if baseline.get(key) != report[key]]
+    return ', '.join(differences) or None
+
+
+def compare(results, baseline, time_threshold, rss_threshold):
+    """
+    :return: list of descriptions of the regressions from the baseline
+    """
+    regressions = []
+    for name, result in sorted(results.items()):
+        before = baseline.get(name)
+        if not before or 'time' not in before or 'time' not in result:
+            continue
+        if result['size'] != before.get('size'):
+            print('{:<16} size differs from the baseline, not compared'.format(name))
+            continue
+        for key, threshold in (('time', time_threshold), ('rss_kb', rss_threshold)):
+            change = (result[key] - before[key]) * 100.0 / before[key]
+            if change > threshold:
+                regressions.append('{} {} {:+.1f}% ({} -> {})'.format(name, key, change, before[key], result[key]))
+    return regressions
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Benchmark the yamp expansion of generated workloads.')
+    parser.add_argument('--scale', type=float, default=1.0, help='multiply the size of every workload')
+    parser.add_argument('--repeats', type=int, default=3, help='take the best time of this many runs')
+    parser.add_argument('--only', help='comma separated workload names, from ' +
+                                       ', '.join(name for name, _, _ in WORKLOADS))
+    parser.add_argument('--engine', choices=sorted(yamp.ENGINES.keys()), default='recursive',
+                        help='the expand() engine to measure')
+    parser.add_argument('--output', metavar='FILE', help='save the results as JSON')
+    parser.add_argument('--baseline', metavar='FILE', default=os.path.join(curr_path, 'baseline.json'),
+                        help='results to compare with, default bench/baseline.json')
+    parser.add_argument('--save-baseline', action='store_true', help='save the results as the new baseline')
+    parser.add_argument('--time-threshold', type=float, default=10.0, metavar='PCT',
+                        help='report a regression if a workload is more than PCT percent slower, default 10')
+    parser.add_argument('--rss-threshold', type=float, default=10.0, metavar='PCT',
+                        help='report a regression if a workload uses more than PCT percent more memory, default 10')
+    options = parser.parse_args(argv[1:])
+    yamp.set_engine(options.engine)
+    only = options.only.split(',') if options.only else None
+
+    results = {}
+    print('{:<16} {:>8} {:>10} {:>12} {:>10}'.format('workload', 'size', 'time s', 'ops/sec', 'peak MB'))
+    for name, workload, size in WORKLOADS:
+        if only and name not in only:
+            continue
+        size = max(1, int(size * options.scale))
+        result = run_workload(workload, size, options.repeats)
+        result['size'] = size
+        results[name] = result
+        if 'error' in result:
+            print('{:<16} {:>8} ERROR {}'.format(name, size, result['error']))
+        else:
+            print('{:<16} {:>8} {:>10.3f} {:>12.0f} {:>10.1f}'.format(
+                name, size, result['time'], result['ops_per_sec'] or 0, result['rss_kb'] / 1024.0))
+
+    report = {'python': platform.python_version(), 'engine': options.engine, 'machine': platform.node(), 'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'results': results}
+    if options.output:
+        with open(options.output, 'w') as fd:
+            json.dump(report, fd, indent=2, sort_keys=True)
+    regressions = []
+    if options.save_baseline:
+        with open(options.baseline, 'w') as fd:
+            json.dump(report, fd, indent=2, sort_keys=True)
+    elif os.path.exists(options.baseline):
+        with open(options.baseline) as fd:
+            baseline = json.load(fd)
+        difference = mismatch(report, baseline)
+        if difference:
+            print('ERROR: {} was measured with {}, not compared'.format(options.baseline, difference))
+            return 1
+        regressions = compare(results, baseline['results'], options.time_threshold, options.rss_threshold)
+        for regression in regressions:
+            print('REGRESSION: ' + regression)
+        if not regressions:
+            print('No regressions from {}'.format(options.baseline))
+    failed = any('error' in result for result in results.values())
+    return 1 if regressions or failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,64 @@
+#!/bin/env python
+"""
+ Benchmark the YAML backends of yamp: time parsing and writing a generated data file
+ and test/all-examples.yaml with each backend available.
+
+ Usage:
+
+      python2 bench/yaml_backends.py [Repeats]
+
+"""
+from __future__ import print_function
+
+import os
+import sys
+import time
+import StringIO
+
+curr_path = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(curr_path + '/../src')
+
+from yamp import YAML_BACKENDS, DocumentWriter, read_yaml_documents, set_yaml_backend
+from yaml import dump
+
+
+def generated_data():
+    hosts = [{'name': 'host{}'.format(i), 'ip': '10.0.{}.{}'.format(i // 256, i % 256),
+              'tags': ['web', 'zone{}'.format(i % 3)], 'port': 8000 + i} for i in range(5000)]
+    return dump({'hosts': hosts}, default_flow_style=False)
+
+
+def best_time(function, repeats):
+    times = []
+    for _ in range(repeats):
+        start = time.time()
+        function()
+        times.append(time.time() - start)
+    return min(times)
+
+
+def bench(name, text, repeats):
+    results = {}
+    for backend in sorted(YAML_BACKENDS.keys()):
+        set_yaml_backend(backend)
+        documents = list(read_yaml_documents(StringIO.StringIO(text)))
+        def write():
+            writer = DocumentWriter(StringIO.StringIO())
+            for doc in documents:
+                writer.add(doc)
+            writer.close()
+        results[backend] = (best_time(lambda: list(read_yaml_documents(StringIO.StringIO(text))), repeats),
+                            best_time(write, repeats))
+    set_yaml_backend()
+    for backend, (load_time, dump_time) in sorted(results.items()):
+        print('{:<24} {:<8} load {:8.3f}s  dump {:8.3f}s'.format(name, backend, load_time, dump_time))
+    if 'c' in results:
+        print('{:<24} {:<8} load {:7.1f}x  dump {:7.1f}x'.format(name, 'speedup',
+              results['python'][0] / results['c'][0], results['python'][1] / results['c'][1]))
+
+
+if __name__ == '__main__':
+    repeats = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    bench('generated {} kB'.format(len(generated_data()) // 1024), generated_data(), repeats)
+    with open(os.path.join(curr_path, '../test/all-examples.yaml')) as fd:
+        bench('all-examples.yaml', fd.read(), repeats)
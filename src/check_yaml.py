@@ -17,13 +17,20 @@ import os
 import sys
 import pprint
 from yaml import load, Loader, dump, dumper
+try:
+    from yaml import CLoader as Loader, CSafeDumper # Use libyaml when it is installed
+except ImportError:
+    CSafeDumper = dumper.SafeDumper
 
 noalias_dumper = dumper.SafeDumper
 noalias_dumper.ignore_aliases = lambda self, data: True # http://signal0.com/2013/02/06/disabling_aliases_in_pyyaml.html
+CSafeDumper.ignore_aliases = lambda self, data: True
 
 def fumpfd(filename, file_descriptor):
     try:
-        print(dump(load(file_descriptor, Loader=Loader), default_flow_style=False, Dumper=noalias_dumper))
+        data = load(file_descriptor, Loader=Loader)
+        # libyaml does not end a scalar document with '...' so use Python for those
+        print(dump(data, default_flow_style=False, Dumper=CSafeDumper if isinstance(data, (list, dict)) else noalias_dumper))
     except Exception as e:
         print("ERROR: {}\n{}\n".format(filename, e), file=sys.stderr)
         sys.exit(1)
@@ -0,0 +1,67 @@
+#!/bin/env python
+"""
+ Fold a yamp trace, written with 'yamp.py --trace FILE', into the folded stack format read by
+ flamegraph.pl and speedscope: one line per stack of frames separated by ';', followed by the
+ microseconds spent in the last frame itself.
+
+ With '--by macro' (the default) the frames are the files and the macro calls, which shows the
+ macros taking the time. With '--by path' the frames are the nodes of the tree, which shows the
+ branches of the templates taking the time.
+
+ Usage:
+
+      python2 fold_trace.py [--by macro|path] trace.jsonl > trace.folded
+      flamegraph.pl trace.folded > trace.svg
+"""
+from __future__ import print_function
+
+import sys
+import json
+import argparse
+from collections import OrderedDict
+
+
+def frames(path, by):
+    """
+    :return: the stack of frame names for an event's path
+    """
+    segments = [unicode(segment) for segment in path]
+    if by == 'path':
+        return [segment.replace(';', ':') for segment in segments]
+    return [segment.replace(';', ':') for segment in segments if segment.startswith('@') or segment.endswith('()')] or ['(top)']
+
+
+def fold(events, by='macro'):
+    """
+    Events arrive as their calls return, so the nested calls of an event precede it, one level deeper.
+    The time of an event itself is its elapsed time less that of the events directly nested in it.
+    :param events: iterable of trace event maps
+    :return: OrderedDict of stack string -> microseconds
+    """
+    nested = {} # depth -> elapsed time of the returned calls at that depth, not yet claimed by their caller
+    stacks = OrderedDict()
+    for event in events:
+        depth = event['depth']
+        own = event['elapsed'] - nested.pop(depth + 1, 0.0)
+        nested[depth] = nested.get(depth, 0.0) + event['elapsed']
+        stack = ';'.join(frames(event['path'], by))
+        stacks[stack] = stacks.get(stack, 0.0) + max(own, 0.0) * 1e6
+    return stacks
+
+
+def read_events(fd):
+    for line in fd:
+        if line.strip():
+            yield json.loads(line)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Fold a yamp trace into flame graph stacks.')
+    parser.add_argument('--by', choices=['macro', 'path'], default='macro',
+                        help='make frames of the files and macro calls, or of every node of the tree')
+    parser.add_argument('trace', help='the trace file written by yamp.py --trace, or - for the standard input')
+    options = parser.parse_args()
+    fd = sys.stdin if options.trace == '-' else open(options.trace)
+    for stack, microseconds in fold(read_events(fd), options.by).items():
+        if int(round(microseconds)):
+            print(u'{} {}'.format(stack, int(round(microseconds))).encode('utf-8'))
@@ -7,18 +7,143 @@
 from __future__ import print_function
 
 import os
+import stat
 
 import re
 import sys
 import json
+import argparse
+import cPickle as pickle
+import hashlib
+import tempfile
+import time
+import yaml
+import StringIO
+import SocketServer
+import multiprocessing.pool
 import math
+import itertools
 import numbers
 import datetime
-from yaml import load, Loader, dump, load_all
+from collections import OrderedDict
+from yaml import load, Loader, dump, Dumper, load_all
+try:
+    from yaml import CLoader, CDumper
+except ImportError:
+    CLoader = CDumper = None # libyaml is not installed
 
 class YampException(Exception):
     pass
 
+class LRUCache(object):
+    """
+    A small bounded mapping which evicts the least recently used entry when full.
+    Each entry has a cost, by default 1, and the total cost is kept within maxsize.
+    Counts hits and misses so callers can report on the cache effectiveness.
+    """
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.costs = {}
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        """
+        Return the value for key, marking it as most recently used, or default if absent.
+        """
+        try:
+            value = self.entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+        self.entries[key] = value
+        self.hits += 1
+        return value
+
+    def put(self, key, value, cost=1):
+        """
+        Store value under key, evicting the oldest entries until it fits.
+        """
+        self.discard(key)
+        while self.entries and self.size + cost > self.maxsize:
+            self.discard(next(iter(self.entries)))
+        self.entries[key] = value
+        self.costs[key] = cost
+        self.size += cost
+
+    def discard(self, key):
+        """
+        Remove key if present.
+        """
+        if key in self.entries:
+            del self.entries[key]
+            self.size -= self.costs.pop(key)
+
+    def clear(self):
+        self.entries.clear()
+        self.costs.clear()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+INTERPOLATION_PATTERN = re.compile('({{[^{]*}})')
+
+class Template(object):
+    """
+    A string parsed once into its literal parts and {{ }} variable slots, ready to be rendered
+    against any environment. Each part is a tuple (variable_name, literal); variable_name is
+    None for literal text.
+    """
+    __slots__ = ('source', 'parts')
+
+    def __init__(self, source, tokens):
+        self.source = source
+        parts = []
+        for tok in tokens:
+            if tok.startswith('{{') and tok.endswith('}}'):
+                parts.append((tok[2:][:-2].strip(), None))
+            else:
+                parts.append((None, tok))
+        self.parts = tuple(parts)
+
+    def render(self, bindings):
+        """
+        Return the source string with each variable slot replaced by its value in bindings.
+        """
+        rebound = []
+        for variable_name, literal in self.parts:
+            if variable_name is None:
+                rebound.append(literal)
+                continue
+            value = expand_str(variable_name, bindings)
+            if value == variable_name:
+                raise(YampException('Undefined interpolation variable "{}" in "{}"'.format(variable_name, self.source)))
+            rebound.append(str(value))
+        return ''.join(rebound)
+
+TEMPLATE_CACHE_SIZE = 10000
+template_cache = LRUCache(TEMPLATE_CACHE_SIZE)
+
+def compile_template(astring):
+    """
+    Return the Template for astring, or None if it has nothing to interpolate.
+    Parsed templates are kept in a bounded LRU cache so that each distinct string is only split once.
+    """
+    template = template_cache.get(astring, False)
+    if template is False:
+        tokens = INTERPOLATION_PATTERN.split(astring)
+        if len(tokens) == 1:
+            template = None # Nothing to interpolate
+        else:
+            template = Template(astring, tokens)
+        template_cache.put(astring, template)
+    return template
+
 def interpolate(astring, bindings):
     """
     Parse a string which may contain embedded variables denoted by curlies {{ }}.
@@ -29,22 +154,12 @@ def interpolate(astring, bindings):
     :return: astring with added values
     """
 
-    if type(astring) != str:
+    if type(astring) != str or '{{' not in astring:
         return astring
-    tokens = re.split('({{[^{]*}})', astring)
-    if len(tokens) == 1:
-        # Nothing to interpolate
+    template = compile_template(astring)
+    if template is None:
         return astring
-    rebound  = []
-    for tok in tokens:
-        value = tok
-        if tok.startswith('{{') and tok.endswith('}}'):
-            variable_name = tok[2:][:-2].strip()
-            value = expand_str(variable_name, bindings)
-            if value == variable_name:
-                raise(YampException('Undefined interpolation variable "{}" in "{}"'.format(variable_name, astring)))
-        rebound.append(str(value))
-    return(''.join(rebound))
+    return template.render(bindings)
 
 #
 # About bindings
@@ -60,12 +175,140 @@ def interpolate(astring, bindings):
 #                     'eager' - meaning expand arguments before execution of macro, expand the result of macro execution
 #                     'lazy' - do not execute arguments before macro call but expand the result
 #                     'quote' - dont expand arguments or expand the result
-#            [1] - a callable Python function value containing the macro or builtin  
+#            [1] - a callable Python function value containing the macro or builtin
+#
+# Environments created by the processor itself are Scope objects. A Scope is still a dict with a
+# visible __parent__ key, so plain dicts, Env and Python code using lookup(__parent__, ...) keep working,
+# but it also remembers the results of searching its parents.
 #
+class Scope(dict):
+    """
+    An environment dict linked to its enclosing environment. Lookups which have to search the
+    parent chain are cached per scope, so that name resolution is close to O(1) however deep the
+    chain is. Any change to a scope which has children invalidates all the caches.
+    Each scope also counts its own changes in its version.
+    """
+    __slots__ = ('parent', 'shared', 'cache', 'cache_epoch', 'version')
+    epoch = 0 # Bumped whenever a scope with children changes
+
+    def __init__(self, parent=None, bindings=None):
+        dict.__init__(self)
+        self.parent = parent
+        self.shared = False
+        self.cache = {}
+        self.cache_epoch = Scope.epoch
+        self.version = 0
+        if parent is not None:
+            dict.__setitem__(self, '__parent__', parent)
+            if type(parent) == Scope:
+                parent.shared = True
+        if bindings:
+            dict.update(self, bindings)
+
+    def changed(self):
+        self.version += 1
+        if self.shared:
+            Scope.epoch += 1
+
+    def __setitem__(self, key, value):
+        self.changed()
+        dict.__setitem__(self, key, value)
+
+    def __delitem__(self, key):
+        self.changed()
+        dict.__delitem__(self, key)
+
+    def update(self, *args, **kwargs):
+        self.changed()
+        dict.update(self, *args, **kwargs)
+
+    def setdefault(self, key, default=None):
+        self.changed()
+        return dict.setdefault(self, key, default)
+
+    def pop(self, key, *default):
+        self.changed()
+        return dict.pop(self, key, *default)
+
+    def popitem(self):
+        self.changed()
+        return dict.popitem(self)
+
+    def clear(self):
+        self.changed()
+        dict.clear(self)
+
+    def __reduce__(self):
+        return (Scope, (self.parent,), None, None, self.iteritems())
+
+    def resolve(self, key):
+        """
+        Find key in the parents of this scope, which does not bind it itself.
+        :return: value, ok - as for lookup()
+        """
+        if self.cache_epoch != Scope.epoch:
+            self.cache = {}
+            self.cache_epoch = Scope.epoch
+        found = self.cache.get(key)
+        if found is not None:
+            return found
+        cacheable = True # Only when no plain dict in the chain can change behind our back
+        env = self.parent
+        while env is not None:
+            is_scope = type(env) == Scope
+            cacheable = cacheable and is_scope
+            if key in env:
+                found = (env[key], True)
+                break
+            env = env.parent if is_scope else env.get('__parent__')
+        else:
+            found = (None, False)
+        if cacheable:
+            self.cache[key] = found
+        return found
+
+    def forget(self):
+        """
+        Drop the cached lookups, to save memory while this scope is kept but not used.
+        The next resolve() starts a new cache.
+        """
+        self.cache = None
+        self.cache_epoch = None
+
+    def versions(self):
+        """
+        :return: a tuple of the versions of this scope and its parents, which changes whenever a binding
+        visible from here may have changed. None if the chain contains a plain dict, which has no version.
+        """
+        versions = []
+        env = self
+        while env is not None:
+            if type(env) != Scope:
+                return None
+            versions.append(env.version)
+            env = env.parent
+        return tuple(versions)
+
+    def snapshot(self):
+        """
+        Flatten the chain into a new root Scope holding every binding visible from this one.
+        Later changes to this chain do not affect the snapshot.
+        """
+        chain = []
+        env = self
+        while env is not None:
+            chain.append(env)
+            env = env.parent if type(env) == Scope else env.get('__parent__')
+        flat = Scope()
+        for env in reversed(chain):
+            dict.update(flat, env)
+        dict.pop(flat, '__parent__', None)
+        return flat
+
 def lookup(env, key):
     """
-    Search an environment stack for a binding of key to a value, 
-    following __parent__ links to higher environment. 
+    Search an environment stack for a binding of key to a value,
+    following __parent__ links to higher environment.
     :param env: Start seaching from this env
     :param key: variable name to look for.
     :return: value, ok - if key is found ok is True and value has the value, otherwise ok is False and value is undefined.
@@ -73,12 +316,86 @@ def lookup(env, key):
     while True:
         if key in env:
             return env[key], True
+        elif type(env) == Scope:
+            return env.resolve(key)
         elif '__parent__' in env:
             env = env['__parent__']
             continue
         else:
             return None, False
 
+MACRO_CACHE_SIZE = 1000
+IMPURE_FORMS = set(['define', 'undefine', 'defmacro', 'include', 'python_eval'])
+SIDE_EFFECT_FORMS = set(['define', 'undefine', 'defmacro', 'include'])
+
+def uses_forms(tree, names):
+    """
+    Return True if any map in the tree has a key in names, or a '^' key which could call anything.
+    """
+    pending = [tree]
+    while pending:
+        tree = pending.pop()
+        if type(tree) == list:
+            pending.extend(tree)
+        elif type(tree) == dict:
+            for k, v in tree.iteritems():
+                if k in names or (type(k) == str and k.startswith('^')):
+                    return True
+                pending.append(v)
+    return False
+
+def calls_forms(tree, bindings, names, seen):
+    """
+    Return True if expanding the tree may use one of the forms in names: a map key in names, a '^' key which
+    could call anything, or a call of a macro whose body does, directly or in the macros it calls in turn.
+    The macros are looked up in bindings.
+    :param seen: set of the ids of macro bodies already checked
+    """
+    pending = [tree]
+    while pending:
+        tree = pending.pop()
+        if type(tree) == list:
+            pending.extend(tree)
+        elif type(tree) == dict:
+            for k, v in tree.iteritems():
+                if k in names or (type(k) == str and k.startswith('^')):
+                    return True
+                if type(k) == str:
+                    func, ok = lookup(bindings, k)
+                    body = getattr(func[1], 'body', None) if ok and type(func) == tuple else None
+                    if type(body) == type(expand):
+                        if BUILTIN_NAMES.get(body) in names:
+                            return True
+                    elif body is not None and id(body) not in seen:
+                        seen.add(id(body))
+                        pending.append(body)
+                pending.append(v)
+    return False
+
+def canonical(tree):
+    """
+    Return a hashable value which is equal for equal trees, and distinguishes types which compare equal
+    such as 1, 1.0 and True. Raises TypeError for values which cannot be hashed. The value is a flat tuple,
+    each list or map giving its type and length followed by its parts, so that deep trees can still be compared.
+    """
+    tokens = []
+    pending = [(None, tree)] # the key, for the values of maps, and the tree to add in turn
+    while pending:
+        key, tree = pending.pop()
+        if key is not None:
+            tokens.extend(key)
+        if type(tree) == dict:
+            tokens.extend((dict, len(tree)))
+            # The keys are scalars, as lists and maps cannot be hashed, and no two in a map are equal
+            pending.extend(sorted((((type(k), k), v) for k, v in tree.iteritems()), reverse=True))
+        elif type(tree) == list:
+            tokens.extend((list, len(tree)))
+            pending.extend((None, item) for item in reversed(tree))
+        else:
+            hash(tree)
+            tokens.extend((type(tree), tree))
+    return tuple(tokens)
+
 def new_macro(tree, bindings):
     """
     Given a macro definition of the form 
@@ -96,7 +413,12 @@ def new_macro(tree, bindings):
     the returned function binds all its actual arguments to the specified args binding.
 
     If 'args' is None no arguments are bound, but if actual arguments are provided the returned function raises an error.
-    :param tree: {'name': <string>, 'macro_type': <eager|lazy|quote>, 'args': None|<list of strings>|<string>, 'value': <anything>}
+
+    If 'memoize' is true the results are cached by the value of the arguments, unless the body uses one of the
+    IMPURE_FORMS, directly or in the macros it calls as they are defined at the time of the call. A 'memoize' of 'force' caches the results regardless. The cache is attached to the function as 'cache',
+    and the body as 'body'.
+    :param tree: {'name': <string>, 'macro_type': <eager|lazy|quote>, 'args': None|<list of strings>|<string>, 'value': <anything>,
+                  'memoize': None|<boolean>|'force'}
     :param bindings: environment to update
     :return: A tuple containing a type tag in [0] and in [1] a new function to apply when the macro is called
     """
@@ -104,15 +426,28 @@ def new_macro(tree, bindings):
     body = tree['value']
     parameters = tree['args'] or []
     macro_type = tree.get('macro_type', 'eager')
-    def apply(seen_tree, args, dynamic_bindings):
+    memoize = tree.get('memoize')
+    if memoize not in (None, True, False, 'force'):
+        raise(YampException('Syntax error "memoize" not true, false or force in {}'.format(tree)))
+    cache = None
+    purity = [None, False] # the versions of the bindings when purity was last checked, and whether the body was pure
+    if type(body) != type(expand):
+        evaluate_body = compile_tree(body)
+        if memoize == 'force' or (memoize and not uses_forms(body, IMPURE_FORMS)):
+            cache = LRUCache(MACRO_CACHE_SIZE)
+    def pure(versions):
         """
-        Given a map of arguments, create a new local environment for this macro expansion, bind the args to the new
-        enviroment, then expand the captured body and return the result. If the captured parameters variable is a string, it is
-        used for variable arguments which are all bound to it.
-        :param seen_tree: Tree as parsed
-        :param args: 
-        :param dynamic_bindings: bindings for builtins 
-        :return:
+        Whether a memoized macro may be cached, given the versions of the bindings. The macros it calls may be
+        redefined, so this is checked again whenever the bindings change.
+        """
+        if memoize == 'force':
+            return True
+        if purity[0] != versions:
+            purity[:] = [versions, not calls_forms(body, bindings, IMPURE_FORMS, set())]
+        return purity[1]
+    def check(seen_tree, args):
+        """
+        Raise an error if the arguments of a call do not match the parameters.
         """
         if type(parameters) == list and args and type(args) != dict:
             raise(YampException('Expecting dict args for {} [ {} ], got: {}'.format(name, parameters, args)))
@@ -121,20 +456,415 @@ def new_macro(tree, bindings):
         if type(parameters) == list and parameters and args:
             if set(parameters or []) != set(args.keys()):
                 raise(YampException('Argument mismatch in {} expected {} got {}'.format(name, parameters, args)))
+        if type(body) != type(expand) and len(seen_tree.keys()) != 1:
+            raise(YampException('ERROR: too many keys in macro call "{}"'.format(seen_tree)))
+    def environment(args):
+        """
+        Create a new local environment for this macro expansion and bind the args to it. If the captured parameters
+        variable is a string, it is used for variable arguments which are all bound to it.
+        """
+        macro_env = Scope(bindings)
+        if type(parameters) == str: # varargs
+            macro_env[parameters] = args
+        else:
+            if args: # Might be None for no args
+                macro_env.update(args)
+        return macro_env
+    def apply(seen_tree, args, dynamic_bindings):
+        """
+        Given a map of arguments, create a new local environment for this macro expansion, bind the args to the new
+        enviroment, then expand the captured body and return the result.
+        :param seen_tree: Tree as parsed
+        :param args: 
+        :param dynamic_bindings: bindings for builtins 
+        :return:
+        """
+        check(seen_tree, args)
         if type(body) == type(expand): # Is this a built-in python function?
             return body(seen_tree, args, dynamic_bindings)
         else:
-            if len(seen_tree.keys()) != 1:
-                raise(YampException('ERROR: too many keys in macro call "{}"'.format(seen_tree)))
-            macro_env = {'__parent__': bindings}
-            if type(parameters) == str: # varargs
-                macro_env[parameters] = args
-            else:
-                if args: # Might be None for no args
-                    macro_env.update(args)
-            return expand(body, macro_env)
+            key = None
+            if cache is not None and type(bindings) == Scope:
+                # The result also depends on the bindings visible where the macro was defined
+                try:
+                    key = (bindings.versions(), canonical(args))
+                except TypeError:
+                    pass # Unhashable arguments are not cached
+                if key is not None and (key[0] is None or not pure(key[0])):
+                    key = None
+                if key is not None:
+                    result = cache.get(key, cache)
+                    if result is not cache:
+                        return result
+            result = evaluate_body(environment(args))
+            if key is not None:
+                cache.put(key, result)
+            return result
+    def bind(seen_tree, args):
+        """
+        Check the arguments of a call and bind them in a new local environment, in which the caller expands the body.
+        """
+        check(seen_tree, args)
+        return environment(args)
+    apply.cache = cache
+    apply.body = body
+    apply.evaluate_body = evaluate_body if type(body) != type(expand) else None
+    apply.bind = bind
+    # The stack engine may expand the body itself, or the branch of an if, instead of calling apply
+    apply.inline = (type(body) != type(expand) and cache is None) or body is if_builtin
+    # Each result is a new tree which shares no part with another, unless it holds a quote or python_eval result
+    apply.fresh = apply.inline or body is repeat_builtin
+    if profiler is not None:
+        apply = profiler.instrument(name, apply)
+    if tracer is not None:
+        apply = tracer.instrument(name, apply)
     return (macro_type, apply)
 
+def tree_size(tree):
+    """
+    :return: the number of maps, lists and scalars in a tree
+    """
+    size = 0
+    pending = [tree]
+    while pending:
+        tree = pending.pop()
+        size += 1
+        if type(tree) == dict:
+            pending.extend(tree.itervalues())
+        elif type(tree) == list:
+            pending.extend(tree)
+    return size
+
+class Profiler(object):
+    """
+    Count the calls of each macro and builtin and the time spent in them. Inclusive time covers the
+    calls made by the macro, exclusive time only its own work. Recursive calls are counted
+    once in the inclusive time. Macros are instrumented as they are defined, so the profiler must be
+    set before new_globals() for the builtins to be counted. With no profiler nothing is instrumented.
+    """
+    SORT_KEYS = ['name', 'calls', 'inclusive', 'exclusive', 'size']
+
+    def __init__(self):
+        self.stats = {} # name -> [kind, calls, inclusive, exclusive, total argument size]
+        self.active = {} # name -> number of calls in progress
+        self.children = [] # time spent in the calls made by each call in progress
+        self.started = time.time()
+
+    def instrument(self, name, apply):
+        """
+        :return: apply wrapped to record its calls under name
+        """
+        kind = 'builtin' if type(apply.body) == type(expand) else 'macro'
+        stats = self.stats
+        active = self.active
+        children = self.children
+        def profiled(seen_tree, args, dynamic_bindings):
+            active[name] = active.get(name, 0) + 1
+            children.append(0.0)
+            start = time.time()
+            try:
+                return apply(seen_tree, args, dynamic_bindings)
+            finally:
+                elapsed = time.time() - start
+                inner = children.pop()
+                if children:
+                    children[-1] += elapsed
+                active[name] -= 1
+                stat = stats.setdefault(name, [kind, 0, 0.0, 0.0, 0])
+                stat[1] += 1
+                if not active[name]:
+                    stat[2] += elapsed
+                stat[3] += elapsed - inner
+                stat[4] += tree_size(args)
+        profiled.cache = apply.cache
+        profiled.body = apply.body
+        return profiled
+
+    def rows(self, sort='exclusive'):
+        """
+        :param sort: one of SORT_KEYS, the name ascending or the others descending
+        :return: list of {'name', 'kind', 'calls', 'inclusive', 'exclusive', 'size'}, where size is the mean argument size
+        """
+        rows = [{'name': name, 'kind': kind, 'calls': calls, 'inclusive': inclusive, 'exclusive': exclusive,
+                 'size': float(size) / calls}
+                for name, (kind, calls, inclusive, exclusive, size) in self.stats.items()]
+        rows.sort(key=lambda row: row['name'])
+        if sort != 'name':
+            rows.sort(key=lambda row: row[sort], reverse=True)
+        return rows
+
+    def report(self, sort='exclusive', output_format='text'):
+        """
+        :return: the report as a text table or as JSON
+        """
+        total = time.time() - self.started
+        rows = self.rows(sort)
+        if output_format == 'json':
+            return json.dumps({'total': total, 'macros': rows}, indent=2, sort_keys=True) + '\n'
+        lines = ['{:<24} {:<8} {:>10} {:>12} {:>12} {:>10}'.format('name', 'kind', 'calls', 'inclusive s', 'exclusive s', 'arg size')]
+        for row in rows:
+            lines.append('{name:<24} {kind:<8} {calls:>10} {inclusive:>12.4f} {exclusive:>12.4f} {size:>10.1f}'.format(**row))
+        lines.append('{:<24} {:<8} {:>10} {:>12.4f} {:>12.4f}'.format('(total)', '', '', total,
+                                                                     total - sum(row['exclusive'] for row in rows)))
+        return '\n'.join(lines) + '\n'
+
+profiler = None
+
+class TraceFrame(object):
+    """
+    A call in progress, seen by the Tracer.
+    """
+    __slots__ = ('path', 'tree', 'index', 'documents')
+
+    def __init__(self, path, tree):
+        self.path = path
+        self.tree = tree
+        self.index = None # id of each child of tree -> list of its keys or indexes, made when first needed
+        self.documents = 0
+
+    def child(self, tree):
+        """
+        :return: the path segment of tree, its key or index if it is a child of this frame's tree, else '*'
+        """
+        if self.index is None:
+            self.index = {}
+            if type(self.tree) == list:
+                for position, item in enumerate(self.tree):
+                    self.index.setdefault(id(item), []).append(position)
+            elif type(self.tree) == dict:
+                for key, value in self.tree.iteritems():
+                    self.index.setdefault(id(value), []).append(key)
+        keys = self.index.get(id(tree))
+        if keys:
+            return str(keys.pop(0))
+        return '*'
+
+class TraceFile(object):
+    """
+    Marks the frame of a file, whose expansions are its documents.
+    """
+
+class Tracer(object):
+    """
+    Report an event for each call of expand(), is_function(), expand_file() and of each macro and builtin as it
+    returns, to a callback. Each event is a map of its 'type', the 'name' of the macro, function key or file,
+    the 'path' of the node in the tree as a list, the current '__FILE__', the 'depth' of nested calls, the 'elapsed'
+    seconds including the nested calls and the 'size' of the result. In the path each file is '@' and its
+    name, each document its number, each macro call its name and '()', each is_function() call '?' and trees
+    made during the expansion, such as macro results, are '*'. Installed by set_tracer().
+    """
+    FUNCTIONS = ['expand', 'is_function', 'expand_file']
+
+    def __init__(self, callback):
+        self.callback = callback
+        self.frames = []
+        self.originals = {}
+
+    def install(self):
+        module = globals()
+        self.originals = dict((name, module[name]) for name in self.FUNCTIONS)
+        # Plain functions rather than bound methods, as the type of expand is used to recognise builtins
+        module['expand'] = lambda tree, bindings: self.traced_expand(tree, bindings)
+        module['is_function'] = lambda tree, bindings: self.traced_is_function(tree, bindings)
+        module['expand_file'] = lambda filename, bindings, *args, **kwargs: self.traced_expand_file(filename, bindings, *args, **kwargs)
+
+    def uninstall(self):
+        globals().update(self.originals)
+
+    def call(self, event_type, name, segment, tree, filename, function, *args, **kwargs):
+        """
+        Call function with a frame for it on the stack, and report its event.
+        """
+        frames = self.frames
+        path = (frames[-1].path if frames else []) + [segment]
+        depth = len(frames)
+        frames.append(TraceFrame(path, tree))
+        start = time.time()
+        try:
+            result = function(*args, **kwargs)
+        finally:
+            elapsed = time.time() - start
+            frames.pop()
+        self.callback({'type': event_type, 'name': name, 'path': path, 'file': filename, 'depth': depth,
+                       'elapsed': elapsed, 'size': tree_size(result)})
+        return result
+
+    def traced_expand(self, tree, bindings):
+        if not self.frames:
+            segment = '*'
+        elif type(self.frames[-1].tree) == TraceFile:
+            segment = str(self.frames[-1].documents)
+            self.frames[-1].documents += 1
+        else:
+            segment = self.frames[-1].child(tree)
+        return self.call('expand', None, segment, tree, lookup(bindings, '__FILE__')[0],
+                         self.originals['expand'], tree, bindings)
+
+    def traced_is_function(self, tree, bindings):
+        name = tree.keys()[0] if len(tree) == 1 else 'if' if 'if' in tree else None
+        return self.call('is_function', name, '?', None, lookup(bindings, '__FILE__')[0],
+                         self.originals['is_function'], tree, bindings)
+
+    def traced_expand_file(self, filename, bindings, *args, **kwargs):
+        return self.call('file', filename, '@' + filename, TraceFile(), filename,
+                         self.originals['expand_file'], filename, bindings, *args, **kwargs)
+
+    def instrument(self, name, apply):
+        """
+        :return: apply wrapped to report its calls under name
+        """
+        def traced(seen_tree, args, dynamic_bindings):
+            return self.call('apply', name, name + '()', None, lookup(dynamic_bindings, '__FILE__')[0],
+                             apply, seen_tree, args, dynamic_bindings)
+        traced.cache = apply.cache
+        traced.body = apply.body
+        return traced
+
+tracer = None
+
+def set_tracer(callback=None):
+    """
+    Report trace events to callback, or stop tracing if it is None. Macros are instrumented as they are defined,
+    so the tracer must be set before new_globals() for the builtins to be reported.
+    """
+    global tracer
+    if tracer is not None:
+        tracer.uninstall()
+        tracer = None
+    if callback is not None:
+        tracer = Tracer(callback)
+        tracer.install()
+
+
+class Dependencies(object):
+    """
+    Record the inputs an expansion actually uses: the files read, and the keys of 'env' and the indexes of
+    'argv' dereferenced. If the whole of 'env' or 'argv' is used, all_env or all_argv is set.
+    If python_eval uses anything which may differ between runs, such as the time, deterministic is cleared.
+    """
+    def __init__(self, env, argv):
+        self.env = env
+        self.argv = argv
+        self.files = []
+        self.env_keys = set()
+        self.argv_indexes = set()
+        self.all_env = False
+        self.all_argv = False
+        self.deterministic = True
+
+    def file(self, path):
+        if path not in self.files:
+            self.files.append(path)
+
+    def used(self, value, key):
+        """
+        Record the dereference of key in value, if value is 'env' or 'argv'.
+        """
+        if value is self.env:
+            self.env_keys.add(key)
+        elif value is self.argv:
+            self.argv_indexes.add(int(key) if type(key) == str and key.isdigit() else key)
+
+    def used_all(self, value):
+        """
+        Record the use of the whole of value, if value is 'env' or 'argv'.
+        """
+        if value is self.env:
+            self.all_env = True
+        elif value is self.argv:
+            self.all_argv = True
+
+    def records(self):
+        """
+        :return: the records, as a tuple which can be passed between processes and given to merge()
+        """
+        return (list(self.files), set(self.env_keys), set(self.argv_indexes), self.all_env, self.all_argv,
+                self.deterministic)
+
+    def merge(self, records):
+        files, env_keys, argv_indexes, all_env, all_argv, deterministic = records
+        for path in files:
+            self.file(path)
+        self.env_keys.update(env_keys)
+        self.argv_indexes.update(argv_indexes)
+        self.all_env = self.all_env or all_env
+        self.all_argv = self.all_argv or all_argv
+        self.deterministic = self.deterministic and deterministic
+
+    def clear(self):
+        self.files = []
+        self.env_keys = set()
+        self.argv_indexes = set()
+        self.all_env = self.all_argv = False
+        self.deterministic = True
+
+    def as_json(self, output=None):
+        """
+        :return: JSON text listing the output and the files, env keys and argv indexes it depends on
+        """
+        return json.dumps({'output': output,
+                           'files': self.files,
+                           'env': sorted(self.env) if self.all_env else sorted(self.env_keys),
+                           'argv': range(len(self.argv)) if self.all_argv else sorted(self.argv_indexes)},
+                          indent=2, sort_keys=True) + '\n'
+
+    def as_make(self, target):
+        """
+        :return: a Makefile rule for target with the files as prerequisites, as also read by Ninja
+        """
+        def escape(path):
+            return path.replace('$', '$$').replace('#', '\\#').replace(' ', '\\ ')
+        files = [escape(path) for path in self.files if path != '-']
+        return '{}: {}\n'.format(escape(target), ' \\\n  '.join(files))
+
+dependencies = None
+
+# Names in a python_eval expression which may give a different result in another run
+NONDETERMINISTIC = re.compile(r'\b(now|utcnow|today|time|clock|random|randint|randrange|choice|shuffle|sample|'
+                              r'uuid1|uuid4|urandom|getpid|getcwd|listdir|walk|glob|stat|exists|isfile|isdir|'
+                              r'open|file|input|raw_input|system|popen|subprocess|__import__|eval|exec|execfile)\b')
+
+class EnvReader(dict):
+    """
+    Copy of the 'env' map given to python_eval, which records the keys read in the Dependencies.
+    """
+    def __init__(self, env, dependencies):
+        dict.__init__(self, env)
+        self.dependencies = dependencies
+
+    def __getitem__(self, key):
+        self.dependencies.env_keys.add(key)
+        return dict.__getitem__(self, key)
+
+    def get(self, key, default=None):
+        self.dependencies.env_keys.add(key)
+        return dict.get(self, key, default)
+
+    def __contains__(self, key):
+        self.dependencies.env_keys.add(key)
+        return dict.__contains__(self, key)
+
+    has_key = __contains__
+
+    def __iter__(self):
+        self.dependencies.all_env = True
+        return dict.__iter__(self)
+
+    def keys(self):
+        self.dependencies.all_env = True
+        return dict.keys(self)
+
+    def items(self):
+        self.dependencies.all_env = True
+        return dict.items(self)
+
+    def values(self):
+        self.dependencies.all_env = True
+        return dict.values(self)
+
+    iterkeys = __iter__
+    iteritems = lambda self: iter(self.items())
+    itervalues = lambda self: iter(self.values())
 
 def subvar_lookup(original, vars_list, tree, bindings):
     """
@@ -160,6 +890,8 @@ def subvar_lookup(original, vars_list, tree, bindings):
         first = vars_list[0]
     if type(first) not in (str, int):
         raise(YampException('Subvariable "{}" not a string or int in {}'.format(first, original)))
+    if dependencies is not None:
+        dependencies.used(tree, first)
     if type(tree) == dict:
         if not first in tree.keys():
             raise(YampException('Subvariable "{}" not found in {}'.format(first, original)))
@@ -167,7 +899,7 @@ def subvar_lookup(original, vars_list, tree, bindings):
             return tree[first]
         else:
             return subvar_lookup(original, vars_list[1:], tree[first], bindings)
-    elif type(tree) == list or type(tree) == tuple:
+    elif type(tree) == list or type(tree) == tuple or type(tree) == Range:
         if type(first) == int:
             index = first
         elif type(first) == str and first.isdigit():
@@ -193,6 +925,8 @@ def expand_str(variable_name, bindings):
     """
     value, ok = lookup(bindings, variable_name)
     if ok:
+        if dependencies is not None:
+            dependencies.used_all(value)
         return value # a simple variable like 'host' or a variable like 'a.c.e' matches first
 
     # nothing simple, look for subvariables.
@@ -206,6 +940,144 @@ def expand_str(variable_name, bindings):
     else:
         return variable_name
 
+quoted_results = 0 # Count of the results of quote and python_eval, which are passed on without being copied
+
+def settled(tree, bindings):
+    """
+    Check, without expanding it, that expanding a tree again would give back an equal tree. There must be no string
+    which names a variable or holds {{ }}, no map key which is a ^ key, holds {{ }} or may name a macro, and no null
+    in a list. The keys and strings are looked up, nothing is expanded or called.
+    :param tree: Any tree, usually the result of an expansion
+    :param bindings: current environment
+    :return: True if expand(tree, bindings) == tree
+    """
+    pending = [tree]
+    while pending:
+        tree = pending.pop()
+        tree_type = type(tree)
+        if tree_type == str:
+            if '{{' in tree or lookup(bindings, tree)[1]:
+                return False
+            if '.' in tree and lookup(bindings, tree.split('.', 1)[0])[1]:
+                return False
+        elif tree_type == list:
+            for item in tree:
+                if item is None:
+                    return False
+            pending.extend(tree)
+        elif tree_type == dict:
+            for k, v in tree.iteritems():
+                if type(k) == str:
+                    if k.startswith('^') or '{{' in k:
+                        return False
+                    value, ok = lookup(bindings, k)
+                    if ok:
+                        if type(value) == tuple or type(value) == str or type(value) == dict:
+                            return False
+                    elif '.' in k and lookup(bindings, k.split('.', 1)[0])[1]:
+                        return False
+                elif type(k) == tuple:
+                    return False
+                pending.append(v)
+    return True
+
+def expand_again(tree, bindings, count):
+    """
+    Expand a tree which was made by expanding another, as expand() does. Usually there is nothing left in it to
+    expand, and then the tree itself is returned rather than a copy. That is only done when the tree cannot share
+    any part with another tree, that is while no quote or python_eval result has been passed on since count was taken.
+    :param tree: a result, made since count was taken
+    :param bindings: current environment
+    :param count: quoted_results before the tree was made
+    :return: the same as expand(tree, bindings)
+    """
+    if count == quoted_results and settled(tree, bindings):
+        return tree
+    return expand(tree, bindings)
+
+def side_effect_free(tree, bindings, seen):
+    """
+    Return True if expanding the tree cannot change the enclosing bindings or write output, that is
+    it uses none of the SIDE_EFFECT_FORMS, directly, under another name, or in the bodies of the macros it calls.
+    :param seen: set of the ids of macro bodies already checked
+    """
+    return not calls_forms(tree, bindings, SIDE_EFFECT_FORMS, seen)
+
+def parallel_processes(tree, statement, bindings):
+    """
+    Return the number of processes a repeat statement asks for with its 'parallel' key: a positive
+    integer, or true for one per CPU. Return 1 if it is absent or false, or if this is already a
+    worker process or the platform cannot fork.
+    """
+    if 'parallel' not in statement:
+        return 1
+    parallel = expand(statement['parallel'], bindings)
+    if parallel is True:
+        processes = multiprocessing.cpu_count()
+    elif parallel is False or parallel is None:
+        return 1
+    elif type(parallel) == int and parallel > 0:
+        processes = parallel
+    else:
+        raise(YampException('Syntax error "parallel" not true, false or a positive integer in {}'.format(tree)))
+    if not can_fork():
+        return 1
+    return processes
+
+def can_fork():
+    """
+    :return: True if worker processes can be forked from here, that is the platform can fork, this is not already
+    a worker and there is no tracer, which would not see the workers' events.
+    """
+    return hasattr(os, 'fork') and not multiprocessing.current_process().daemon and tracer is None
+
+parallel_iteration = None
+
+def run_parallel_iteration(index):
+    """
+    Run one iteration of the current parallel loop in a worker process.
+    :return: (True, result, records) or (False, exception, records), where records are the Dependencies
+    used by the iteration, if tracked
+    """
+    iteration, items = parallel_iteration
+    if dependencies is not None:
+        dependencies.clear()
+    try:
+        outcome = True, iteration(items[index])
+    except (Exception, SystemExit) as e:
+        try:
+            pickle.loads(pickle.dumps(e))
+        except Exception:
+            e = YampException(str(e))
+        outcome = False, e
+    return outcome + (dependencies.records() if dependencies is not None else None,)
+
+def parallel_map(iteration, items, processes):
+    """
+    Call iteration on each of the items in a pool of forked worker processes, which inherit the
+    bindings so only the results are passed back.
+    :return: list of (True, result) or (False, exception) in the order of the items, or None if a
+    result could not be passed back.
+    """
+    global parallel_iteration
+    processes = min(processes, len(items))
+    sys.stdout.flush() # The workers flush inherited buffers when they exit
+    sys.stderr.flush()
+    parallel_iteration = (iteration, items)
+    pool = multiprocessing.Pool(processes)
+    try:
+        outcomes = pool.map(run_parallel_iteration, xrange(len(items)), max(1, len(items) // (processes * 4)))
+        if dependencies is not None:
+            for _, _, records in outcomes:
+                dependencies.merge(records)
+        return [(ok, value) for ok, value, _ in outcomes]
+    except multiprocessing.pool.MaybeEncodingError:
+        return None
+    finally:
+        parallel_iteration = None
+        pool.terminate()
+        pool.join()
+
 def expand_repeat_dict(tree, statement, bindings):
     """
     Expand a repeat loop and return a map, with a parameteriseed key. Create a local environment for the
@@ -214,24 +1086,52 @@ def expand_repeat_dict(tree, statement, bindings):
     :param bindings:
     :return: The Expanse
     """
-    rang = expand(expand(statement['in'], bindings), bindings)
+    count = quoted_results
+    rang = expand_again(evaluate(statement['in'], bindings), bindings, count)
     var = statement['for']
     body = statement['body']
     key = statement['key']
-    if type(rang) != list:
+    if not is_sequence(rang):
         raise(YampException('Syntax error "in" not list in {}'.format(rang)))
     if type(var) != str:
         raise(YampException('Syntax error "for" not string in {}'.format(statement)))
     if type(key) != str:
         raise(YampException('Syntax error "key" not string in {}'.format(statement)))
     result = {}
-    loop_binding = {'__parent__': bindings}
+    loop_binding = Scope(bindings)
+    evaluate_key = compile_str(key)
+    evaluate_body = compiled(body)
+    processes = parallel_processes(tree, statement, bindings)
+    if processes > 1 and len(rang) > 1 and side_effect_free([key, body], bindings, set()):
+        def iteration(item):
+            loop_binding[var] = item
+            count = quoted_results
+            keyvalue = expand_again(evaluate_key(loop_binding), loop_binding, count)
+            try:
+                count = quoted_results
+                return keyvalue, True, expand_again(evaluate_body(loop_binding), loop_binding, count)
+            except Exception as e:
+                return keyvalue, False, e
+        outcomes = parallel_map(iteration, rang, processes)
+        if outcomes is not None:
+            for ok, outcome in outcomes:
+                if not ok:
+                    raise(outcome)
+                keyvalue, ok, value = outcome
+                if keyvalue in result:
+                    raise(YampException('ERROR: key "{}" duplication in {}'.format(keyvalue,tree)))
+                if not ok:
+                    raise(value)
+                result[keyvalue] = value
+            return result
     for item in rang:
         loop_binding[var] = item
-        keyvalue = expand(expand(key, loop_binding), loop_binding)
+        count = quoted_results
+        keyvalue = expand_again(evaluate_key(loop_binding), loop_binding, count)
         if keyvalue in result:
             raise(YampException('ERROR: key "{}" duplication in {}'.format(keyvalue,tree)))
-        result[keyvalue] = expand(expand(body, loop_binding), loop_binding)
+        count = quoted_results
+        result[keyvalue] = expand_again(evaluate_body(loop_binding), loop_binding, count)
     return result
 
 def expand_repeat_list(tree, statement, bindings):
@@ -242,18 +1142,32 @@ def expand_repeat_list(tree, statement, bindings):
     :param bindings:
     :return: The Expanse
     """
-    rang = expand(expand(statement['in'], bindings), bindings)
+    count = quoted_results
+    rang = expand_again(evaluate(statement['in'], bindings), bindings, count)
     var = statement['for']
     body = statement['body']
-    if type(rang) != list:
+    if not is_sequence(rang):
         raise(YampException('Syntax error "in" not list in {}'.format(rang)))
     if type(var) != str:
         raise(YampException('Syntax error "for" not string in {}'.format(statement)))
     result = []
-    loop_binding = {'__parent__': bindings}
+    loop_binding = Scope(bindings)
+    evaluate_body = compiled(body)
+    processes = parallel_processes(tree, statement, bindings)
+    if processes > 1 and len(rang) > 1 and side_effect_free(body, bindings, set()):
+        def iteration(item):
+            loop_binding[var] = item
+            return evaluate_body(loop_binding)
+        outcomes = parallel_map(iteration, rang, processes)
+        if outcomes is not None:
+            for ok, outcome in outcomes:
+                if not ok:
+                    raise(outcome)
+                result.append(outcome)
+            return result
     for item in rang:
         loop_binding[var] = item
-        result.append(expand(body, loop_binding))
+        result.append(evaluate_body(loop_binding))
     return result
 
 def map_define(arglist, bindings):
@@ -279,12 +1193,19 @@ def flatten_list(listy, bindings):
     :return:
     """
     result = []
-    for rawitem in listy:
-        item = expand(rawitem, bindings)
-        if not type(item) == list:
-            result.append(item) # atoms or maps
+    pending = [iter(listy)] # the lists being flattened, innermost last
+    while pending:
+        for rawitem in pending[-1]:
+            item = expand(rawitem, bindings)
+            if type(item) == Range:
+                result.extend(item) # integers need no further expansion
+            elif not type(item) == list:
+                result.append(item) # atoms or maps
+            else:
+                pending.append(iter(item)) # list, continue with its items
+                break
         else:
-            result.extend(flatten_list(item, bindings)) # list
+            pending.pop()
     return result
 
 def flat_list(depth, listy):
@@ -300,7 +1221,7 @@ def flat_list(depth, listy):
         return listy
     result = []
     for item in listy:
-        if not type(item) == list:
+        if not is_sequence(item):
             result.append(item) # atoms or maps
         else:
             result.extend(flat_list(depth -1, item)) # list
@@ -344,9 +1265,9 @@ def validate_params(tree, tree_proto, args, args_proto):
     """
     if len(tree.keys()) != len(tree_proto):
             raise(YampException('Syntax error incorrect number of keys in {}'.format(tree)))
-    if type(args) != type(args_proto):
+    if type(args) != type(args_proto) and not (type(args_proto) == list and type(args) == Range):
             raise(YampException('Syntax error incorrect argument type. Expected {} in {}'.format(type(args_proto), tree)))
-    if type(args) in [list, dict]:         # Is it something with a length?
+    if type(args) in [list, dict, Range]:         # Is it something with a length?
         if len(args) < len(args_proto):
                 raise(YampException('Syntax error too few arguments. Expected {} in {}'.format(len(args_proto), tree)))
 
@@ -408,9 +1329,80 @@ def str_2_int(x):
   except ValueError:
       return None, False
   
+class Range(object):
+    """
+    An inclusive integer sequence from start to end which does not hold its items in memory.
+    It behaves as a read-only list: it has a length, can be indexed and iterated, equals the
+    list of the same items and is written out as a YAML sequence.
+    """
+    __slots__ = ('start', 'end', 'items')
+
+    def __init__(self, start, end):
+        self.start = start
+        self.end = end
+        if start <= end:
+            self.items = xrange(start, end+1)
+        else:
+            self.items = xrange(start, end-1, -1)
+
+    def __len__(self):
+        return len(self.items)
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __getitem__(self, index):
+        if type(index) == slice:
+            return list(self)[index]
+        return self.items[index]
+
+    def index(self, item):
+        if item not in self:
+            raise(ValueError('{} is not in range'.format(item)))
+        return abs(item - self.start)
+
+    def count(self, item):
+        return 1 if item in self else 0
+
+    def __add__(self, other):
+        return list(self) + other
+
+    def __radd__(self, other):
+        return other + list(self)
+
+    def __contains__(self, item):
+        if type(item) != int:
+            return False
+        return min(self.start, self.end) <= item <= max(self.start, self.end)
+
+    def __eq__(self, other):
+        if type(other) == Range:
+            return (self.start, self.end) == (other.start, other.end)
+        if type(other) == list:
+            return len(self) == len(other) and all(a == b for a, b in zip(self.items, other))
+        return NotImplemented
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        if equal is NotImplemented:
+            return equal
+        return not equal
+
+    def __hash__(self):
+        return hash((Range, self.start, self.end))
+
+    def __repr__(self):
+        return repr(list(self))
+
+def is_sequence(value):
+    """
+    :return: True if value is a list or a Range
+    """
+    return type(value) == list or type(value) == Range
+
 def range_builtin(tree, statement, bindings):
     """
-    :return: a list from  statement[0] to statement[1]
+    :return: a Range from  statement[0] to statement[1], or a list of the keys of a map
     """
     if not statement:
        raise(YampException('range: was expecting map or integer sequence in {}'.format(tree)))
@@ -421,13 +1413,7 @@ def range_builtin(tree, statement, bindings):
         end, eok = str_2_int(statement[1])
         if not sok or not eok: 
             raise(YampException('range: {} is not an integer in {}'.format(statement, tree)))
-        if start < end:
-          result = list(range(start, end+1))
-        else:
-          result = list(range(start, end-1, -1))
-        if len(result) == 0:
-            raise(YampException('range: empty range in {}'.format(tree)))
-        return result
+        return Range(start, end)
     elif type(statement) == dict:
         return list(statement.keys())
     else:
@@ -488,6 +1474,12 @@ class Env(dict):
     value, ok = lookup(self, key)
     if not ok:
          raise(KeyError('python_eval: variable not found "{}"'.format(key)))
+    if dependencies is not None:
+        if value is dependencies.env:
+            return EnvReader(value, dependencies)
+        dependencies.used_all(value)
+    if type(value) == Range:
+        return list(value) # Python code expects a real list
     return value
 
 def python_builtin(tree, args, bindings):
@@ -500,7 +1492,21 @@ def python_builtin(tree, args, bindings):
     :return: Expanse
     """
     validate_params(tree, {'': None}, args, '')
-    return eval('(' + args + ')', globals(), Env(bindings))
+    local_variables = Env(bindings)
+    for key, value in local_variables.items():
+        if type(value) == Range:
+            local_variables[key] = list(value) # Python code expects a real list
+    if dependencies is not None:
+        if '__parent__' in args or 'environ' in args or 'getenv' in args:
+            dependencies.all_env = dependencies.all_argv = True
+        if NONDETERMINISTIC.search(args):
+            dependencies.deterministic = False
+        for key, value in local_variables.items():
+            if value is dependencies.env:
+                local_variables[key] = EnvReader(value, dependencies)
+            elif value is dependencies.argv and key in args:
+                dependencies.used_all(value)
+    return eval('(' + args + ')', globals(), local_variables)
 
 def repeat_builtin(tree, args, bindings):
     """
@@ -510,7 +1516,7 @@ def repeat_builtin(tree, args, bindings):
     :param bindings:
     :return: The Expanse
     """
-    validate_keys(['for', 'in', 'body', ('key',)], args)
+    validate_keys(['for', 'in', 'body', ('key',), ('parallel',)], args)
     
     if 'key' in tree['repeat']:
         return expand_repeat_dict(tree, args, bindings)
@@ -550,31 +1556,42 @@ def defmacro_builtin(tree, args, bindings):
     """
     if not args:
         raise(YampException('Syntax error empty defmacro {}'.format(tree)))
-    validate_keys(['name', 'args', 'value'], args)
+    validate_keys(['name', 'args', 'value', ('memoize',)], args)
     bindings[args['name']] = new_macro(args, bindings)
     return None
 
-def if_builtin(tree, args, bindings):
+def if_branch(tree, bindings, condition=None):
     """
-    Conditional expression
-    :return: either the expansion of the 'then' or 'else' elements. 
+    Check a conditional expression and expand its condition.
+    :param condition: the compiled condition, if there is one
+    :return: 'then' or 'else', the key of the branch to expand, or None
     """
     if 'else' not in tree.keys() and 'then' not in tree.keys():
         raise(YampException('Syntax error "then" or "else" missing in {}'.format(tree)))
     extras = set(tree.keys()) - set(['if', 'then', 'else'])
     if extras:
         raise(YampException('Syntax error extra keys {} in {}'.format(extras, tree)))
-    condition = expand(tree['if'], bindings)
+    condition = expand(tree['if'], bindings) if condition is None else condition(bindings)
     if condition not in [True, False, None]:
         raise(YampException('If condition not "true", "false" or "null". Got: "{}" in {}'.format(condition, tree)))
     if condition == True and 'then' in tree.keys():
-        expanded = expand(tree['then'], bindings)
-        return expand(expanded, bindings)
+        return 'then'
     elif (condition == False or condition == None) and 'else' in tree.keys():
-        expanded = expand(tree['else'], bindings)
-        return expand(expanded, bindings)
+        return 'else'
     return None
 
+def if_builtin(tree, args, bindings):
+    """
+    Conditional expression
+    :return: either the expansion of the 'then' or 'else' elements. 
+    """
+    branch = if_branch(tree, bindings)
+    if branch is None:
+        return None
+    count = quoted_results
+    expanded = evaluate(tree[branch], bindings)
+    return expand_again(expanded, bindings, count)
+
 def quote_builtin(tree, args, bindings):
     """
     :return: the args without expansion
@@ -582,33 +1599,57 @@ def quote_builtin(tree, args, bindings):
     validate_single(tree)
     return args
 
+BUILTINS = [
+    ('flatten', flatten_builtin, 'eager'),
+    ('flatone', flatone_builtin, 'eager'),
+    ('merge', merge_builtin, 'eager'),
+    ('==', equals_builtin, 'eager'),
+    ('+', plus_builtin, 'eager'),
+    ('range', range_builtin, 'eager'),
+    ('include', include_builtin, 'eager'),
+    ('load', load_builtin, 'eager'),
+    ('define', define_builtin, 'lazy'),
+    ('undefine', undefine_builtin, 'lazy'),
+    ('defmacro', defmacro_builtin, 'lazy'),
+    ('if', if_builtin, 'lazy'),
+    ('repeat', repeat_builtin, 'lazy'),
+    ('python_eval', python_builtin, 'quote'),
+    ('quote', quote_builtin, 'quote')]
+# The name each builtin function is registered under, so that it is still known when bound to another name
+BUILTIN_NAMES = dict((fn, name) for name, fn, func_type in BUILTINS)
+
 def add_builtins_to_env(env):
     """
     Utility function to add all the builtins to an environment
     :env: Environment to add to
     :return: The environment
     """
-    def add_new_builtin(name, fn, func_type='eager'):
-        env[name] = new_macro({'name': name, 'args': 'varargs', 'value': fn, 'macro_type': func_type},  env) 
-
-    add_new_builtin('flatten', flatten_builtin)
-    add_new_builtin('flatone', flatone_builtin)
-    add_new_builtin('merge', merge_builtin)
-    add_new_builtin('==', equals_builtin)
-    add_new_builtin('+', plus_builtin)
-    add_new_builtin('range', range_builtin)
-    add_new_builtin('include', include_builtin)
-    add_new_builtin('load', load_builtin)
-    add_new_builtin('define', define_builtin, 'lazy')
-    add_new_builtin('undefine', undefine_builtin, 'lazy')
-    add_new_builtin('defmacro', defmacro_builtin, 'lazy')
-    add_new_builtin('if', if_builtin, 'lazy')
-    add_new_builtin('repeat', repeat_builtin, 'lazy')
-    add_new_builtin('python_eval', python_builtin, 'quote')
-    add_new_builtin('quote', quote_builtin, 'quote')
+    for name, fn, func_type in BUILTINS:
+        env[name] = new_macro({'name': name, 'args': 'varargs', 'value': fn, 'macro_type': func_type},  env)
     
     return env
 
+def key_function(k, bindings):
+    """
+    Look up a map key which may name a macro. The key is expanded only when it is bound to a function, or to
+    a string or map which may expand to one. A key bound to a list or a scalar, or to nothing, is not a macro
+    call and is left for expand() to interpolate once when it builds the new map.
+    :param k: a map key, other than a ^ key
+    :param bindings: current environment
+    :return: what expand(k, bindings) gives if that may be a function tuple, otherwise None
+    """
+    if type(k) != str:
+        return k
+    value, ok = lookup(bindings, k)
+    if ok:
+        if type(value) == tuple:
+            return value # as expand() would give it
+        if type(value) != str and type(value) != dict:
+            return None
+    elif '.' not in k or not lookup(bindings, k.split('.', 1)[0])[1]:
+        return None
+    return expand(k, bindings)
+
 def is_function(tree, bindings):
     """
     Return function tuple and rhs if this is a function call, else False
@@ -623,7 +1664,7 @@ def is_function(tree, bindings):
             if not ok:
                 raise(YampException('ERROR: Variable {} not defined in {}'.format(variable_name, tree)))
         else: 
-            func = expand(k, bindings)
+            func = key_function(k, bindings)
         return func
 
     func = None
@@ -643,6 +1684,96 @@ def is_function(tree, bindings):
             raise(YampException('ERROR: too many keys in macro {}'.format(tree)))
     return False, None
 
+def apply_macro(apply, tree, args, bindings):
+    """
+    Apply an eager macro to its expanded args and expand the result, as expand() does for a call.
+    When the body of the macro is an 'if' whose branch is itself a call of an eager macro, as in a recursive
+    loop, that call is made here by going round again rather than by recursion, so the depth of the Python
+    stack does not grow with the depth of the recursion. The expansions of the result still owed to each
+    level are counted in a list and done at the end. The body, its condition and its branches are evaluated by
+    the closures compiled for them, without dispatching on the tree again. When a macro calls itself this way,
+    the scope of the caller is dropped and the expansions it is owed are done in the scope of the new call,
+    which binds the same names, so a loop runs in constant memory.
+    :param apply: the macro function
+    :param tree: the call as parsed
+    :param args: the expanded arguments of the call
+    :param bindings: the bindings of the call
+    :return: the expanded result of the call
+    """
+    pending = [] # [bindings, times] in which the result is expanded again, outermost first
+    owner = None # the macro whose call made the bindings of the last entry in pending
+    count = quoted_results
+    fresh = True
+    while True:
+        if pending and pending[-1][0] is bindings:
+            pending[-1][1] += 1
+        else:
+            pending.append([bindings, 1])
+        body = getattr(apply, 'body', None)
+        if not getattr(apply, 'inline', False) or type(body) != dict or 'if' not in body:
+            result = apply(tree, args, bindings)
+            fresh = getattr(apply, 'fresh', False)
+            break
+        macro_env = apply.bind(tree, args)
+        evaluate_body = apply.evaluate_body
+        func = evaluate_body.call_func(macro_env)
+        if type(func) != tuple or not getattr(func[1], 'inline', False) or func[1].body is not if_builtin:
+            result = evaluate_body(macro_env)
+            break
+        branch = if_branch(body, macro_env, evaluate_body.condition)
+        if branch is None:
+            result = None
+            break
+        # Owed twice by the body, as a lazy call, and by if_builtin
+        if apply is owner and macro_env.viewkeys() == bindings.viewkeys():
+            pending[-1][0] = macro_env # nothing else refers to the caller's scope
+            pending[-1][1] += 2
+        else:
+            pending.append([macro_env, 2])
+        owner = apply
+        tree = body[branch]
+        evaluate_branch = evaluate_body.branches[branch]
+        if type(tree) == dict:
+            func = evaluate_branch.call_func(macro_env)
+            if type(func) == tuple and func[0] == 'eager':
+                apply = func[1]
+                args = evaluate_branch.call_args(macro_env)
+                if bindings is not pending[0][0]:
+                    bindings.forget() # not used again until the result is expanded
+                bindings = macro_env
+                continue
+        result = evaluate_branch(macro_env)
+        break
+    settled_in = None # the bindings in which the result was last found to need no more expansion
+    for bindings, times in reversed(pending):
+        for _ in xrange(times):
+            if fresh and (bindings is settled_in or (count == quoted_results and settled(result, bindings))):
+                settled_in = bindings
+                break # nor will it the remaining times
+            count = quoted_results
+            result = expand(result, bindings)
+            fresh = True
+            settled_in = None
+    return result
+
+def expand_lazy(apply, tree, rhs, bindings):
+    """
+    Apply a lazy macro to its unexpanded args and expand the result, as expand() does for a call.
+    """
+    count = quoted_results
+    result = apply(tree, rhs, bindings)
+    if getattr(apply, 'fresh', False):
+        return expand_again(result, bindings, count)
+    return expand(result, bindings)
+
+def apply_quote(apply, tree, rhs, bindings):
+    """
+    Apply a quote macro, whose result is not expanded or copied, and count it.
+    """
+    global quoted_results
+    quoted_results += 1
+    return apply(tree, rhs, bindings)
+
 def expand(tree, bindings):
     """
     This is the eval function of the macro-processor.  It takes a any kind of YAML-generated combination of
@@ -676,11 +1807,11 @@ def expand(tree, bindings):
         func, rhs = is_function(tree, bindings)
         if func :
             if func[0] == 'eager':
-                return(expand(func[1](tree, expand(rhs, bindings), bindings), bindings))
+                return(apply_macro(func[1], tree, expand(rhs, bindings), bindings))
             elif func[0] == 'lazy':
-                return(expand(func[1](tree, rhs, bindings), bindings))
+                return(expand_lazy(func[1], tree, rhs, bindings))
             else: # quote
-                return(func[1](tree, rhs, bindings))
+                return(apply_quote(func[1], tree, rhs, bindings))
 
         # Just a normal map - not a function
         for k,v in tree.iteritems():
@@ -707,22 +1838,1018 @@ def expand(tree, bindings):
     else:
         return tree
 
+expand_recursive = expand
+
+# Continuations of the stack engine
+EXPAND_AGAIN, INTERPOLATE, EXPAND_LIST, EXPAND_MAP, CALL_MACRO = range(5)
+
+def expand_stack(tree, bindings):
+    """
+    Compute exactly what expand_recursive() does, errors included, with an explicit stack of continuations
+    in place of the Python stack. Nested lists and maps, calls of macros and the branches of 'if' are expanded
+    on this stack, so their depth is limited only by memory. Other builtins are called as usual, and their own
+    calls of expand() start a new stack. Memoized, profiled and traced macros are also called as usual.
+    Scalars and plain strings in lists and maps, and strings which name a plain string, are expanded without a
+    continuation of their own. As in expand_again(), a result which would come back the same from another
+    expansion is not expanded again. As in
+    apply_macro(), when a macro whose body is an 'if' calls itself from the branch, the scope of the caller is
+    dropped and the expansions it is owed are done in the scope of the new call.
+    Selected by set_engine('stack').
+    :param tree: Any tree as generated by reading YAML.
+    :param bindings: A hierarchy of symbol-tables of variables and bindings, connected by their __parent__ keys.
+    :return:     Return a new tree
+    """
+    stack = []
+    bound_apply = bound_scope = None # the last macro called inline, and the scope it was bound in
+    if_apply = None # the last 'if' expanded inline
+    while True:
+        # Expand tree in bindings, either to a value or by pushing a continuation and moving on to a subtree
+        tree_type = type(tree)
+        if tree_type == str:
+            result = expand_str(tree, bindings)
+            if result == tree:
+                value = interpolate(tree, bindings)
+            elif type(result) != str:
+                tree = result
+                continue
+            elif expand_str(result, bindings) == result:
+                value = interpolate(interpolate(result, bindings), bindings)
+            else:
+                stack.append((INTERPOLATE, bindings))
+                tree = result
+                continue
+        elif tree_type == list:
+            stack.append([EXPAND_LIST, tree, bindings, 0, []])
+            value = NOTHING
+        elif tree_type == dict:
+            func = False
+            if len(tree) != 1:
+                func, rhs = is_function(tree, bindings)
+            else:
+                for k in tree:
+                    # Only a key which may name a macro is a call, as key_function() would find
+                    if type(k) != str or k.startswith('^') or '{{' in k:
+                        func, rhs = is_function(tree, bindings)
+                        break
+                    found, ok = lookup(bindings, k)
+                    if not ok:
+                        if '.' in k:
+                            func, rhs = is_function(tree, bindings)
+                    elif type(found) == tuple:
+                        func, rhs = found, tree[k]
+                    elif type(found) == str or type(found) == dict:
+                        func, rhs = is_function(tree, bindings)
+            if func:
+                macro_type, apply = func
+                if macro_type == 'eager':
+                    stack.append((CALL_MACRO, apply, tree, bindings))
+                    tree = rhs
+                    continue
+                elif macro_type == 'lazy':
+                    if apply is if_apply or (getattr(apply, 'inline', False) and apply.body is if_builtin):
+                        if_apply = apply
+                        branch = if_branch(tree, bindings)
+                        if branch is not None:
+                            # Owed twice, by the body as a lazy call and by if_builtin
+                            top = stack[-1] if stack else None
+                            if top is not None and top[0] == EXPAND_AGAIN and top[1] is bindings:
+                                top[2] += 2
+                            elif bindings is not bound_scope or tree is not bound_apply.body:
+                                stack.append([EXPAND_AGAIN, bindings, 2, None, quoted_results])
+                            elif (top is not None and top[0] == EXPAND_AGAIN and top[3] is bound_apply and
+                                  top[1].viewkeys() == bindings.viewkeys()):
+                                top[1] = bindings # nothing else refers to the caller's scope
+                                top[2] += 2
+                            else:
+                                stack.append([EXPAND_AGAIN, bindings, 2, bound_apply, quoted_results])
+                            tree = tree[branch]
+                            continue
+                        value = None
+                    else:
+                        count = quoted_results
+                        value = apply(tree, rhs, bindings)
+                        if not (getattr(apply, 'fresh', False) and count == quoted_results and settled(value, bindings)):
+                            tree = value
+                            continue
+                else: # quote
+                    value = apply_quote(apply, tree, rhs, bindings)
+            else:
+                stack.append([EXPAND_MAP, tree, bindings, tree.iteritems(), {}, None])
+                value = NOTHING
+        else:
+            value = tree
+
+        # Pass the value to the continuations until one has another tree to expand
+        while stack:
+            frame = stack[-1]
+            kind = frame[0]
+            if kind == EXPAND_LIST:
+                _, items, item_bindings, position, newlist = frame
+                if value is not NOTHING and value != None:
+                    newlist.append(value)
+                tree = NOTHING
+                while position < len(items):
+                    item = items[position]
+                    position += 1
+                    item_type = type(item)
+                    if item_type == str:
+                        result = expand_str(item, item_bindings)
+                        if result == item:
+                            newlist.append(interpolate(item, item_bindings))
+                            continue
+                        if type(result) == str:
+                            if expand_str(result, item_bindings) == result:
+                                newlist.append(interpolate(interpolate(result, item_bindings), item_bindings))
+                                continue
+                            stack.append((INTERPOLATE, item_bindings))
+                        tree = result
+                        break
+                    elif item_type == list or item_type == dict:
+                        tree = item
+                        break
+                    elif item != None:
+                        newlist.append(item)
+                if tree is not NOTHING:
+                    frame[3] = position
+                    bindings = item_bindings
+                    break
+                stack.pop()
+                value = newlist
+            elif kind == EXPAND_MAP:
+                if value is not NOTHING:
+                    frame[4][frame[5]] = value
+                tree = next_map_entry(frame, stack)
+                if tree is not NOTHING:
+                    bindings = frame[2]
+                    break
+                stack.pop()
+                value = frame[4]
+            elif kind == INTERPOLATE:
+                stack.pop()
+                value = interpolate(value, frame[1])
+            elif kind == EXPAND_AGAIN:
+                if frame[4] == quoted_results and settled(value, frame[1]):
+                    stack.pop() # nor would it the remaining times
+                    continue
+                if frame[2] > 1:
+                    frame[2] -= 1
+                else:
+                    stack.pop()
+                tree = value
+                bindings = frame[1]
+                break
+            else: # CALL_MACRO with the expanded arguments
+                stack.pop()
+                _, apply, call, bindings = frame
+                if apply is bound_apply or getattr(apply, 'inline', False):
+                    top = stack[-1] if stack else None
+                    if top is not None and top[0] == EXPAND_AGAIN and top[1] is bindings:
+                        top[2] += 1
+                    else:
+                        stack.append([EXPAND_AGAIN, bindings, 1, None, quoted_results])
+                    bindings = apply.bind(call, value)
+                    bound_apply, bound_scope = apply, bindings
+                    tree = apply.body
+                    break
+                count = quoted_results
+                value = apply(call, value, bindings)
+                if getattr(apply, 'fresh', False) and count == quoted_results and settled(value, bindings):
+                    continue
+                tree = value
+                break
+        else:
+            return value
+
+NOTHING = object() # No value yet
+
+def next_map_entry(frame, stack):
+    """
+    Move a map continuation of expand_stack() on through the entries, checking and interpolating their keys and
+    adding the scalars, plain strings and strings which name a plain string to the new map, until one needs
+    expanding on the stack.
+    :param frame: [EXPAND_MAP, tree, bindings, iterator of the tree's entries, new map, key of the entry being expanded]
+    :return: the tree to expand for the entry, or NOTHING at the end of the map
+    """
+    _, tree, bindings, entries, newdict, _ = frame
+    for k, v in entries:
+        if type(k) == str and k.startswith('^'):
+            variable_name = k[1:]
+            key, ok = lookup(bindings, variable_name)
+            if not ok:
+                raise(YampException('ERROR: Variable {} not defined in {}'.format(variable_name, tree)))
+        else:
+            key = interpolate(k, bindings)
+            if key != k:
+                # string contains {{ }} - only these keys are expanded
+                if key in newdict:
+                    raise(YampException('ERROR: duplicate map key "{}" in {}'.format(key, tree)))
+            elif k in newdict:
+                raise(YampException('ERROR: duplicate map key "{}" in {}'.format(k, tree)))
+        value_type = type(v)
+        if value_type == str:
+            result = expand_str(v, bindings)
+            if result == v:
+                newdict[key] = interpolate(v, bindings)
+                continue
+            if type(result) == str:
+                if expand_str(result, bindings) == result:
+                    newdict[key] = interpolate(interpolate(result, bindings), bindings)
+                    continue
+                stack.append((INTERPOLATE, bindings))
+            frame[5] = key
+            return result
+        elif value_type == list or value_type == dict:
+            frame[5] = key
+            return v
+        newdict[key] = v
+    return NOTHING
+
+ENGINES = {'recursive': expand_recursive, 'stack': expand_stack}
+
+def set_engine(name='recursive'):
+    """
+    Select the function used for expand(), one of the ENGINES. Set it before any tracer.
+    """
+    if name not in ENGINES:
+        raise(YampException('Unknown engine "{}", engines are {}'.format(name, sorted(ENGINES.keys()))))
+    globals()['expand'] = ENGINES[name]
+
+#
+# About compiled trees
+#
+# Macro bodies, repeat bodies and if branches are evaluated many times over. Rather than have expand()
+# classify every node again on each visit, compile_tree() does the classification once and returns a
+# tree of closures, each with the signature (bindings), which compute exactly what expand() would.
+# The closures still look up variables and macros at run time, since define can change them.
+#
+COMPILE_CACHE_SIZE = 1000
+compile_cache = LRUCache(COMPILE_CACHE_SIZE)
+
+def compile_str(tree):
+    """
+    Compile a string node: a variable reference, a dot notation variable or an interpolated string.
+    """
+    template = compile_template(tree) if '{{' in tree else None
+    subvar = tree.split('.')
+    top_name = subvar[0]
+    subvar_names = subvar[1:]
+    def evaluate_str(bindings):
+        result, ok = lookup(bindings, tree)
+        if ok and dependencies is not None:
+            dependencies.used_all(result)
+        if not ok:
+            result = tree
+            if subvar_names:
+                topvalue, ok = lookup(bindings, top_name)
+                if ok:
+                    result = subvar_lookup(tree, subvar_names, topvalue, bindings)
+        if result == tree:
+            if template is None:
+                return tree
+            return template.render(bindings)
+        if type(result) == str:
+            return interpolate(expand(result, bindings), bindings)
+        elif type(result) == list or type(result) == dict:
+            return expand(result, bindings)
+        return result # as expand() would give it
+    return evaluate_str
+
+def compile_list(tree):
+    """
+    Compile a list node, None results are dropped.
+    """
+    items = [compile_tree(item) for item in tree]
+    def evaluate_list(bindings):
+        newlist = []
+        for item in items:
+            expanded = item(bindings)
+            if expanded != None:
+                newlist.append(expanded)
+        return newlist
+    return evaluate_list
+
+def compile_function_key(k, tree):
+    """
+    Compile the lookup of a map key as a macro name, as done by is_function().
+    """
+    if type(k) == str and k.startswith('^'):
+        variable_name = k[1:]
+        def evaluate_caret_key(bindings):
+            func, ok = lookup(bindings, variable_name)
+            if not ok:
+                raise(YampException('ERROR: Variable {} not defined in {}'.format(variable_name, tree)))
+            return func
+        return evaluate_caret_key
+    def evaluate_key(bindings):
+        return key_function(k, bindings)
+    return evaluate_key
+
+def compile_map(tree):
+    """
+    Compile a map node, which at run time is either a macro call or a plain map with interpolated keys.
+    """
+    keys = tree.keys()
+    if len(keys) == 1:
+        call_key = keys[0]
+    elif 'if' in tree: # Special case :-(
+        call_key = 'if'
+    else:
+        call_key = None
+    call_func = compile_function_key(call_key, tree)
+    call_args = compile_tree(tree[call_key]) if call_key in tree else None
+    condition = compile_tree(tree['if']) if 'if' in tree else None
+    branches = dict((k, compile_tree(tree[k])) for k in ('then', 'else') if k in tree)
+    entries = []
+    for k, v in tree.iteritems():
+        key_func = compile_function_key(k, tree)
+        if type(k) == str and k.startswith('^'):
+            entries.append((k, key_func, k[1:], None, compile_tree(v)))
+        else:
+            template = compile_template(k) if type(k) == str and '{{' in k else None
+            entries.append((k, key_func, None, template, compile_tree(v)))
+
+    def evaluate_map(bindings):
+        func = call_func(bindings)
+        if type(func) != tuple:
+            for k, key_func, _, _, _ in entries:
+                if type(key_func(bindings)) == tuple:
+                    raise(YampException('ERROR: too many keys in macro {}'.format(tree)))
+        else:
+            rhs = tree[call_key]
+            if func[0] == 'eager':
+                return(apply_macro(func[1], tree, call_args(bindings), bindings))
+            elif func[0] == 'lazy':
+                if call_key == 'if' and getattr(func[1], 'inline', False) and func[1].body is if_builtin:
+                    return evaluate_if(bindings)
+                return(expand_lazy(func[1], tree, rhs, bindings))
+            else: # quote
+                return(apply_quote(func[1], tree, rhs, bindings))
+
+        # Just a normal map - not a function
+        newdict = {}
+        for k, _, variable_name, template, value in entries:
+            if variable_name is not None:
+                key, ok = lookup(bindings, variable_name)
+                if not ok:
+                    raise(YampException('ERROR: Variable {} not defined in {}'.format(variable_name, tree)))
+                newdict[key] = value(bindings)
+                continue
+            if template is not None:
+                interp_k = template.render(bindings)
+                if interp_k != k:
+                    # string contains {{ }} - only these keys are expanded
+                    if interp_k in newdict:
+                        raise(YampException('ERROR: duplicate map key "{}" in {}'.format(interp_k, tree)))
+                    newdict[interp_k] = value(bindings)
+                    continue
+            if k in newdict:
+                raise(YampException('ERROR: duplicate map key "{}" in {}'.format(k, tree)))
+            newdict[k] = value(bindings)
+        return newdict
+
+    def evaluate_if(bindings):
+        """
+        Expand the map as expand_lazy() does a call of if_builtin(), with the compiled condition and branch.
+        """
+        count = quoted_results
+        branch = if_branch(tree, bindings, condition)
+        if branch is None:
+            return None
+        branch_count = quoted_results
+        result = branches[branch](bindings)
+        if branch_count == quoted_results and settled(result, bindings):
+            # if_builtin() leaves it, and so does expand_lazy() unless the condition held a quote
+            return result if count == quoted_results else expand(result, bindings)
+        return expand_again(expand(result, bindings), bindings, count)
+
+    # apply_macro() takes a body apart with these
+    evaluate_map.call_func = call_func
+    evaluate_map.call_args = call_args
+    evaluate_map.condition = condition
+    evaluate_map.branches = branches
+    return evaluate_map
+
+def compile_tree(tree):
+    """
+    Compile any tree as generated by reading YAML into a closure which takes the bindings and returns
+    the same result as expand(tree, bindings). The closures of a macro call and of an 'if' look up the
+    function at run time, as the name may be bound to another, and the results of calls are still checked
+    for anything left to expand. The macro_loop workload of bench/suite.py measures the gain.
+    :param tree: Any tree as generated by reading YAML.
+    :return: function of (bindings)
+    """
+    if type(tree) == str:
+        return compile_str(tree)
+    elif type(tree) == list:
+        return compile_list(tree)
+    elif type(tree) == dict:
+        return compile_map(tree)
+    else:
+        def evaluate_constant(bindings):
+            return tree
+        return evaluate_constant
+
+def compiled(tree):
+    """
+    Return the compiled form of a tree which is likely to be expanded again, such as a loop body.
+    Compiled forms are cached by the identity of the tree; the cache keeps the tree alive so the
+    identity cannot be reused. Scalars are not worth compiling and get expand() itself.
+    :return: function of (bindings)
+    """
+    if type(tree) != list and type(tree) != dict:
+        return lambda bindings: expand(tree, bindings)
+    entry = compile_cache.get(id(tree))
+    if entry is None or entry[0] is not tree:
+        entry = (tree, compile_tree(tree))
+        compile_cache.put(id(tree), entry)
+    return entry[1]
+
+def evaluate(tree, bindings):
+    """
+    Expand a tree using its cached compiled form.
+    :return: The same as expand(tree, bindings)
+    """
+    if type(tree) != list and type(tree) != dict:
+        return expand(tree, bindings)
+    return compiled(tree)(bindings)
+
 def byteify(input):
     """
     Function to replace all Unicode strings with plain-old-ascii (UTF-8) ones. See author's description:
     https://stackoverflow.com/questions/956867/how-to-get-string-objects-instead-of-unicode-from-json/13105359#13105359 
     """
-    if isinstance(input, dict):
-        return {byteify(key): byteify(value)
-                for key, value in input.iteritems()}
-    elif isinstance(input, list):
-        return [byteify(element) for element in input]
-    elif isinstance(input, unicode):
-        return input.encode('utf-8')
-    else:
-        return input
+    holder = [input]
+    pending = [(holder, 0)] # (container, key) of the values still to convert
+    while pending:
+        container, key = pending.pop()
+        value = container[key]
+        if isinstance(value, dict):
+            converted = {}
+            for k, v in value.iteritems():
+                k = k.encode('utf-8') if isinstance(k, unicode) else k
+                converted[k] = v
+                pending.append((converted, k))
+            container[key] = converted
+        elif isinstance(value, list):
+            converted = list(value)
+            pending.extend((converted, i) for i in range(len(converted)))
+            container[key] = converted
+        elif isinstance(value, unicode):
+            container[key] = value.encode('utf-8')
+    return holder[0]
+
+# The budget counts the bytes of the source files, not of the parsed trees, which take several times as much memory
+PARSE_CACHE_BUDGET = 64 * 1024 * 1024
+parse_cache = LRUCache(PARSE_CACHE_BUDGET)
+
+def read_yaml_documents(fd):
+    """
+    :return: generator of the YAML documents in the file
+    """
+    return load_all(fd, Loader=yaml_loader)
+
+def read_json_documents(fd):
+    """
+    :return: list holding the JSON document in the file
+    """
+    return [byteify(json.load(fd))]
 
-def expand_file(filename, bindings, expandafterload=True, outputfile=None):
+def file_digest(path):
+    """
+    :return: hash of the content of the file at path, or None if it cannot be read
+    """
+    try:
+        with open(path, 'rb') as fd:
+            return hashlib.sha1(fd.read()).hexdigest()
+    except IOError:
+        return None
+
+program_digest = None
+
+class DiskCache(object):
+    """
+    A directory of parsed files kept between runs. Each entry is the pickled list of documents of a file,
+    named by a hash of the file's content and of the parser, so an edited file is simply a new entry.
+    The output of whole expansions may also be kept, as result entries named by a hash of the command line.
+    A result entry is used only if the files, env keys and argv it used are unchanged.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, content, parse):
+        """
+        :return: file name of the entry for content parsed by parse()
+        """
+        settings = '{} {} {} {}'.format(parse.__name__, yaml_loader.__name__, yaml.__version__, pickle.HIGHEST_PROTOCOL)
+        return hashlib.sha1(settings + '\0' + content).hexdigest() + '.pickle'
+
+    def parse(self, path, parse):
+        """
+        Parse the file at path with parse(fd), reusing the entry for its content if there is one.
+        :return: list of documents
+        """
+        with open(path) as fd:
+            content = fd.read()
+        entry = os.path.join(self.directory, self.key(content, parse))
+        try:
+            with open(entry, 'rb') as fd:
+                documents = pickle.loads(fd.read())
+            self.hits += 1
+            return documents
+        except Exception:
+            self.misses += 1
+        stream = StringIO.StringIO(content)
+        stream.name = path # For error messages
+        documents = list(parse(stream))
+        self.store(entry, documents)
+        return documents
+
+    def store(self, entry, value):
+        """
+        Write value to the entry file, unless it cannot be written.
+        """
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            fd, temporary = tempfile.mkstemp(dir=self.directory)
+            with os.fdopen(fd, 'wb') as tempfd:
+                tempfd.write(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+            os.rename(temporary, entry) # Readers never see part of an entry
+        except (IOError, OSError, pickle.PicklingError):
+            pass # Not cached this time
+
+    def result_key(self, filename, argv, settings):
+        """
+        :param settings: list of the command line options which change the output
+        :return: file name of the result entry for expanding filename with argv
+        """
+        global program_digest
+        if program_digest is None:
+            program_digest = file_digest(os.path.splitext(__file__)[0] + '.py') or file_digest(__file__)
+        text = json.dumps([program_digest, os.path.abspath(filename), os.getcwd(), argv, settings,
+                           yaml_loader.__name__, yaml_dumper.__name__, yaml.__version__])
+        return hashlib.sha1(text).hexdigest() + '.result'
+
+    def result(self, key, env):
+        """
+        :param env: the environment the expansion would see
+        :return: the stored {'output': text, 'records': Dependencies records} for key, or None if there is
+        none or any of the files or env variables it used have changed
+        """
+        try:
+            with open(os.path.join(self.directory, key), 'rb') as fd:
+                entry = pickle.loads(fd.read())
+        except Exception:
+            self.misses += 1
+            return None
+        if entry['all_env']:
+            fresh = entry['env'] == env
+        else:
+            fresh = all(env.get(name) == value for name, value in entry['env'].items())
+        fresh = fresh and all(file_digest(path) == digest for path, digest in entry['files'])
+        if not fresh:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry
+
+    def put_result(self, key, dependencies, output):
+        """
+        Keep output as the result for key, with the hashes of the files and the values of the env variables
+        recorded in dependencies.
+        """
+        env = dependencies.env
+        self.store(os.path.join(self.directory, key), {
+            'output': output,
+            'records': dependencies.records(),
+            'files': [(path, file_digest(path)) for path in dependencies.files],
+            'all_env': dependencies.all_env,
+            'env': dict(env) if dependencies.all_env else dict((name, env.get(name)) for name in dependencies.env_keys)})
+
+    def entries(self):
+        """
+        :return: list of the entry file names
+        """
+        if not os.path.isdir(self.directory):
+            return []
+        return [os.path.join(self.directory, name) for name in os.listdir(self.directory)
+                if name.endswith('.pickle') or name.endswith('.result')]
+
+    def clear(self):
+        """
+        Remove all the entries.
+        """
+        for entry in self.entries():
+            os.remove(entry)
+
+    def stats(self):
+        """
+        :return: description of the size of the cache and of its use by this process
+        """
+        entries = self.entries()
+        return 'Yamp cache {}: {} entries, {} bytes, {} hits, {} misses'.format(
+            self.directory, len(entries), sum(os.path.getsize(entry) for entry in entries), self.hits, self.misses)
+
+disk_cache = None
+server_disk_cache = None # The disk_cache of a server, for the requests which do not give a --cache-dir
+
+def parse_file(path, parse):
+    """
+    Parse the file at path with parse(fd), for an include or load. The documents are kept in the parse_cache, with
+    the size of the source file counting against its budget, and reused until the file's modification time, size
+    or inode changes.
+    So the same trees are shared by every include or load of the file and must not be modified.
+    If there is a disk_cache it is tried before parsing. Files too big for the cache are parsed as they are read.
+    :param parse: function of an open file returning a sequence of documents
+    :return: list of documents, or a generator of them
+    """
+    path = os.path.abspath(path)
+    statinfo = os.stat(path)
+    if statinfo.st_size > parse_cache.maxsize:
+        return parse(open(path))
+    version = (statinfo.st_mtime, statinfo.st_size, statinfo.st_ino)
+    entry = parse_cache.get((path, parse))
+    if entry is None or entry[0] != version:
+        if disk_cache is not None:
+            entry = (version, disk_cache.parse(path, parse))
+        else:
+            with open(path) as fd:
+                entry = (version, list(parse(fd)))
+        parse_cache.put((path, parse), entry, max(1, statinfo.st_size))
+    return entry[1]
+
+class YampRepresenter(object):
+    """
+    Mixin for YAML Dumpers which also write the Yamp types. A Range is only materialised here, as it is written.
+    """
+    def ignore_aliases(self, data):
+        if type(data) == Range:
+            return True
+        return super(YampRepresenter, self).ignore_aliases(data)
+
+class LibyamlLayout(object):
+    """
+    Mixin for PyYAML's Python Emitter which lays out keys and double quoted scalars as libyaml does, so that
+    the Python and C backends write the same text. libyaml takes a carriage return as a line break, writes an
+    empty key or one of 128 characters as a simple key, writes a scalar with an explicit tag, such as a unicode
+    string, plain where it can, and folds long double quoted scalars only at spaces.
+    """
+    def analyze_scalar(self, scalar):
+        analysis = super(LibyamlLayout, self).analyze_scalar(scalar)
+        if u'\r' in scalar:
+            analysis.multiline = True
+        return analysis
+
+    def check_simple_key(self):
+        length = 0
+        if isinstance(self.event, yaml.NodeEvent) and self.event.anchor is not None:
+            if self.prepared_anchor is None:
+                self.prepared_anchor = self.prepare_anchor(self.event.anchor)
+            length += len(self.prepared_anchor)
+        if isinstance(self.event, yaml.ScalarEvent):
+            implicit = self.event.implicit[0] or self.event.implicit[1]
+        else:
+            implicit = getattr(self.event, 'implicit', True)
+        if getattr(self.event, 'tag', None) is not None and (self.canonical or not implicit):
+            # Only a tag which is written counts
+            if self.prepared_tag is None:
+                self.prepared_tag = self.prepare_tag(self.event.tag)
+            length += len(self.prepared_tag)
+        if isinstance(self.event, yaml.ScalarEvent):
+            if self.analysis is None:
+                self.analysis = self.analyze_scalar(self.event.value)
+            if self.analysis.multiline:
+                return False
+            length += len(self.analysis.scalar)
+        elif isinstance(self.event, yaml.SequenceStartEvent) and not self.check_empty_sequence():
+            return False
+        elif isinstance(self.event, yaml.MappingStartEvent) and not self.check_empty_mapping():
+            return False
+        return length <= 128
+
+    def choose_scalar_style(self):
+        if self.analysis is None:
+            self.analysis = self.analyze_scalar(self.event.value)
+        analysis = self.analysis
+        if self.event.style == '"' or self.canonical or (self.simple_key_context and analysis.multiline):
+            return '"'
+        style = self.event.style
+        if not style:
+            # libyaml writes the tag only if neither style is implicit, so a tagged scalar may still be plain
+            if ((analysis.allow_flow_plain if self.flow_level else analysis.allow_block_plain)
+                    and not (analysis.empty and (self.flow_level or self.simple_key_context))
+                    and not (self.event.implicit[1] and not self.event.implicit[0])):
+                return ''
+            style = "'"
+        if style == "'":
+            return style if analysis.allow_single_quoted else '"'
+        if analysis.allow_block and not self.flow_level and not self.simple_key_context:
+            return style
+        return '"'
+
+    def write_double_quoted(self, text, split=True):
+        self.write_indicator(u'"', True)
+        spaces = False
+        for index, ch in enumerate(text):
+            if ch in u'"\\\x85\u2028\u2029\uFEFF\r\n' or not (u'\x20' <= ch <= u'\x7E' or (self.allow_unicode
+                    and (u'\xA0' <= ch <= u'\uD7FF' or u'\uE000' <= ch <= u'\uFFFD' or ch >= u'\U00010000'))):
+                if ch in self.ESCAPE_REPLACEMENTS:
+                    data = u'\\' + self.ESCAPE_REPLACEMENTS[ch]
+                elif ch <= u'\xFF':
+                    data = u'\\x%02X' % ord(ch)
+                elif ch <= u'\uFFFF':
+                    data = u'\\u%04X' % ord(ch)
+                else:
+                    data = u'\\U%08X' % ord(ch)
+                spaces = False
+            elif ch == u' ':
+                if split and not spaces and self.column > self.best_width and 0 < index < len(text) - 1:
+                    # The line break is read back as this space
+                    self.write_indent()
+                    self.whitespace = False
+                    self.indention = False
+                    data = u'\\' if text[index + 1] == u' ' else u''
+                else:
+                    data = ch
+                spaces = True
+            else:
+                data = ch
+                spaces = False
+            self.column += len(data)
+            if self.encoding:
+                data = data.encode(self.encoding)
+            self.stream.write(data)
+        self.write_indicator(u'"', False)
+
+class YampDumper(YampRepresenter, LibyamlLayout, Dumper):
+    pass
+
+YampDumper.add_representer(Range, lambda dumper, data: dumper.represent_list(data))
+YAML_BACKENDS = {'python': (Loader, YampDumper)}
+
+if CDumper is not None:
+    class YampCDumper(YampRepresenter, CDumper):
+        pass
+
+    YampCDumper.add_representer(Range, lambda dumper, data: dumper.represent_list(data))
+    YAML_BACKENDS['c'] = (CLoader, YampCDumper)
+
+def set_yaml_backend(name='auto'):
+    """
+    Select the YAML parser and emitter used for files and output: 'c' for the libyaml extension, 'python' for
+    PyYAML's own code, or 'auto' for libyaml if it is installed, otherwise Python.
+    :return: the name of the backend selected
+    """
+    global yaml_loader, yaml_dumper
+    if name == 'auto':
+        name = 'c' if 'c' in YAML_BACKENDS else 'python'
+    if name not in YAML_BACKENDS:
+        raise(YampException('YAML backend "{}" is not available, choose from {}'.format(name, sorted(YAML_BACKENDS.keys()))))
+    yaml_loader, yaml_dumper = YAML_BACKENDS[name]
+    return name
+
+set_yaml_backend()
+
+class DocumentEmitter(object):
+    """
+    Write a document to a file as a series of YAML events while walking the tree, rather than building its
+    whole representation and text in memory as dump() does. Only a set of the ids of the objects which may
+    be aliased is kept, to find those which appear more than once and so need anchors. As in dump(), these are
+    all but the objects the dumper's ignore_aliases() accepts, so shared dates and the like are anchored as well
+    as lists and maps. The output is the same as dump(doc, Dumper=dumper_class, default_flow_style=False).
+    """
+    PLAIN_TYPES = (str, unicode, bool, int, float, type(None)) # never aliased, checked before ignore_aliases()
+
+    def __init__(self, outputfile, dumper_class):
+        self.dumper = dumper_class(outputfile, default_flow_style=False, encoding='utf-8')
+        self.sort_keys = getattr(self.dumper, 'sort_keys', True)
+        self.anchors = {}
+        self.emitted = set()
+
+    def emit(self, doc):
+        dumper = self.dumper
+        try:
+            self.find_anchors(doc, set())
+            dumper.open()
+            dumper.emit(yaml.DocumentStartEvent())
+            self.emit_value(doc)
+            dumper.emit(yaml.DocumentEndEvent())
+            dumper.close()
+        finally:
+            dumper.dispose()
+
+    def may_alias(self, data):
+        return type(data) not in self.PLAIN_TYPES and not self.dumper.ignore_aliases(data)
+
+    def items(self, data):
+        items = data.items()
+        if self.sort_keys:
+            items.sort()
+        return items
+
+    def find_anchors(self, data, seen):
+        """
+        Name the objects found more than once, in the order the Serializer would.
+        """
+        pending = [data]
+        while pending:
+            data = pending.pop()
+            if not self.may_alias(data):
+                continue
+            if id(data) in seen:
+                if id(data) not in self.anchors:
+                    self.anchors[id(data)] = u'id%03d' % (len(self.anchors) + 1)
+                continue
+            seen.add(id(data))
+            if type(data) == list:
+                pending.extend(reversed(data))
+            elif type(data) == dict:
+                pending.extend(part for item in reversed(self.items(data)) for part in reversed(item))
+
+    def anchor(self, data):
+        """
+        :return: the anchor of an object found more than once, noting that it is now emitted, or None
+        """
+        anchor = self.anchors.get(id(data))
+        if anchor is not None:
+            self.emitted.add(id(data))
+        return anchor
+
+    def emit_value(self, data):
+        """
+        Emit the events for the tree, walking it with a stack of iterators over the lists and maps in progress,
+        each with the event which ends it.
+        """
+        dumper = self.dumper
+        stack = []
+        while True:
+            if data is stack:
+                dumper.emit(stack.pop()[1])
+            elif id(data) in self.emitted:
+                dumper.emit(yaml.AliasEvent(self.anchors[id(data)]))
+            elif type(data) == list or type(data) == Range:
+                anchor = self.anchor(data)
+                dumper.emit(yaml.SequenceStartEvent(anchor, u'tag:yaml.org,2002:seq', True, flow_style=False))
+                stack.append((iter(data), yaml.SequenceEndEvent()))
+            elif type(data) == dict:
+                anchor = self.anchor(data)
+                dumper.emit(yaml.MappingStartEvent(anchor, u'tag:yaml.org,2002:map', True, flow_style=False))
+                stack.append((itertools.chain.from_iterable(self.items(data)), yaml.MappingEndEvent()))
+            else:
+                node = dumper.represent_data(data)
+                dumper.represented_objects = {}
+                dumper.object_keeper = []
+                self.emit_node(node, self.anchor(data))
+            if not stack:
+                return
+            data = next(stack[-1][0], stack)
+
+    def emit_node(self, node, anchor):
+        """
+        Emit the events for a represented scalar, or any other value, as the Serializer would.
+        :param anchor: for the value itself, or None
+        """
+        dumper = self.dumper
+        stack = []
+        while True:
+            if node is stack:
+                dumper.emit(stack.pop()[1])
+            elif isinstance(node, yaml.ScalarNode):
+                detected_tag = dumper.resolve(yaml.ScalarNode, node.value, (True, False))
+                default_tag = dumper.resolve(yaml.ScalarNode, node.value, (False, True))
+                implicit = (node.tag == detected_tag), (node.tag == default_tag)
+                dumper.emit(yaml.ScalarEvent(anchor, node.tag, implicit, node.value, style=node.style))
+            elif isinstance(node, yaml.SequenceNode):
+                implicit = node.tag == dumper.resolve(yaml.SequenceNode, node.value, True)
+                dumper.emit(yaml.SequenceStartEvent(anchor, node.tag, implicit, flow_style=node.flow_style))
+                stack.append((iter(node.value), yaml.SequenceEndEvent()))
+            else:
+                implicit = node.tag == dumper.resolve(yaml.MappingNode, node.value, True)
+                dumper.emit(yaml.MappingStartEvent(anchor, node.tag, implicit, flow_style=node.flow_style))
+                stack.append((itertools.chain.from_iterable(node.value), yaml.MappingEndEvent()))
+            anchor = None
+            if not stack:
+                return
+            node = next(stack[-1][0], stack)
+
+class DocumentWriter(object):
+    """
+    Write expanded documents to an output file, each preceded by a '---' line when there is more than one.
+
+    By default the documents are held until close(), so any output of included files comes first. When
+    streaming, the first document is held only until the second arrives, then every document is written
+    and flushed as soon as it is added. Either way at most one document need be kept in memory when streaming.
+    """
+    def __init__(self, outputfile, stream=False):
+        self.outputfile = outputfile
+        self.stream = stream
+        self.pending = []
+        self.count = 0
+
+    def add(self, doc):
+        self.count += 1
+        if not self.stream or self.count == 1:
+            self.pending.append(doc)
+            return
+        for pending_doc in self.pending:
+            self.write(pending_doc, True)
+        self.pending = []
+        self.write(doc, True)
+        self.outputfile.flush()
+
+    def write(self, doc, separator):
+        if separator:
+            self.outputfile.write('---\n')
+        # libyaml does not end a scalar document with '...' as PyYAML does, and a scalar is quick to write anyway
+        dumper = yaml_dumper if type(doc) in (list, dict, Range) else YampDumper
+        DocumentEmitter(self.outputfile, dumper).emit(doc)
+
+    def close(self):
+        for pending_doc in self.pending:
+            self.write(pending_doc, self.count > 1)
+        self.pending = []
+
+class YampJSONEncoder(json.JSONEncoder):
+    """
+    JSON encoder for the values a YAML document can hold. Ranges are written as arrays and dates and times as
+    ISO 8601 strings, anything else JSON cannot represent is an error.
+    """
+    def default(self, o):
+        if type(o) == Range:
+            return list(o)
+        if isinstance(o, (datetime.date, datetime.time)):
+            return o.isoformat()
+        raise(YampException('Cannot write {} as JSON: {}'.format(type(o), repr(o))))
+
+def json_document(doc, **kwargs):
+    """
+    :return: the JSON text of the document, keys sorted as in YAML output
+    """
+    try:
+        return json.dumps(doc, cls=YampJSONEncoder, sort_keys=True, allow_nan=False, **kwargs)
+    except (TypeError, ValueError) as e: # Bad keys, NaN or not UTF-8
+        raise(YampException('Cannot write document as JSON: {} in {}'.format(e, repr(doc)[:200])))
+
+class JsonWriter(DocumentWriter):
+    """
+    Write expanded documents to an output file as JSON, in an array when there is more than one.
+    """
+    def __init__(self, outputfile, stream=False):
+        super(JsonWriter, self).__init__(outputfile, stream)
+        self.written = 0
+
+    def write(self, doc, separator):
+        if separator:
+            self.outputfile.write('[\n' if self.written == 0 else ',\n')
+        self.outputfile.write(json_document(doc, indent=2, separators=(',', ': ')))
+        self.written += 1
+
+    def close(self):
+        super(JsonWriter, self).close()
+        if self.written > 0:
+            self.outputfile.write('\n]\n' if self.count > 1 else '\n')
+
+class NdjsonWriter(DocumentWriter):
+    """
+    Write each expanded document to an output file as soon as it is added, as a line of JSON.
+    """
+    def add(self, doc):
+        self.count += 1
+        self.outputfile.write(json_document(doc, separators=(',', ':')) + '\n')
+        self.outputfile.flush()
+
+DOCUMENT_WRITERS = {'yaml': DocumentWriter, 'json': JsonWriter, 'ndjson': NdjsonWriter}
+
+def expand_documents(documents, bindings, jobs=1):
+    """
+    Generate the expansion of each document in turn. With more than one job, the documents after the last one
+    which could change the bindings are expanded in parallel by that many worker processes, each starting from
+    the bindings left by the earlier documents. The results are still generated in document order.
+    :param documents: iterable of trees
+    :param bindings: global environment
+    :param jobs: number of worker processes
+    """
+    prefix = None
+    if jobs > 1 and can_fork():
+        documents = list(documents)
+        prefix = 0
+        for index, tree in enumerate(documents):
+            if uses_forms(tree, SIDE_EFFECT_FORMS):
+                prefix = index + 1
+    for index, tree in enumerate(documents):
+        if index == prefix and len(documents) - prefix > 1 and side_effect_free(documents[prefix:], bindings, set()):
+            outcomes = parallel_map(lambda tree: expand(tree, bindings), documents[prefix:], jobs)
+            if outcomes is not None:
+                for ok, outcome in outcomes:
+                    if not ok:
+                        raise(outcome)
+                    yield outcome
+                return
+        yield expand(tree, bindings)
+
+def expand_file(filename, bindings, expandafterload=True, outputfile=None, stream=None, jobs=None, output_format=None):
     """
     Read and optionally expand a file in the global environment.
 
@@ -734,6 +2861,9 @@ def expand_file(filename, bindings, expandafterload=True, outputfile=None):
     :param bindings:
     :param expandafterload:
     :param outputfile:
+    :param stream: write each document as soon as it is expanded, inherited by included files if None
+    :param jobs: number of processes to expand independent documents, inherited by included files if None
+    :param output_format: one of the DOCUMENT_WRITERS, inherited by included files if None
     :return:     No return value
     """
     def expand_yaml():
@@ -742,24 +2872,24 @@ def expand_file(filename, bindings, expandafterload=True, outputfile=None):
         """
         try:
             if path == '-':
-                fd = sys.stdin
+                doc_gen = read_yaml_documents(sys.stdin)
             else:
                 statinfo = os.stat(path)
                 if statinfo.st_size == 0:
                     print("ERROR: empty file {}".format(path), file=sys.stderr)
                     sys.exit(1)
-                fd = open(path)
-            doc_gen = load_all(fd, Loader=Loader)
+                if expandafterload and current_file is None:
+                    # The top-level file is parsed as it is expanded, so that --stream can write each document
+                    # before the next is read
+                    doc_gen = read_yaml_documents(open(path))
+                else:
+                    doc_gen = parse_file(path, read_yaml_documents)
             if expandafterload:
-                expanded = []
-                for tree in doc_gen:
-                    expanded_tree = expand(tree, bindings)
+                writer = DOCUMENT_WRITERS[output_format](outputfile, stream)
+                for expanded_tree in expand_documents(doc_gen, bindings, jobs):
                     if expanded_tree and expanded_tree != [] and expanded_tree != {}:
-                        expanded.append(expanded_tree)
-                for output_doc in expanded:
-                   if len(expanded) > 1 :
-                        outputfile.write('---\n')
-                   outputfile.write(dump(output_doc, default_flow_style=False))
+                        writer.add(expanded_tree)
+                writer.close()
             else:
                 return [tree for tree in doc_gen]
         except Exception as e:
@@ -771,7 +2901,7 @@ def expand_file(filename, bindings, expandafterload=True, outputfile=None):
         Process JSON data (no expansions)
         """
         try:
-            data = byteify(json.load(open(path)))
+            data = parse_file(path, read_json_documents)[0]
             return data
         except YampException as e:
             print("ERROR: {}\n{}\n".format(path, e), file=sys.stderr)
@@ -794,6 +2924,18 @@ def expand_file(filename, bindings, expandafterload=True, outputfile=None):
     elif '__current_output__' not in bindings:
         # First time called
         bindings['__current_output__'] = outputfile
+    if stream is None:
+        stream = lookup(bindings, '__stream__')[0] or False
+    else:
+        bindings['__stream__'] = stream
+    if jobs is None:
+        jobs = lookup(bindings, '__jobs__')[0] or 1
+    else:
+        bindings['__jobs__'] = jobs
+    if output_format is None:
+        output_format = lookup(bindings, '__output_format__')[0] or 'yaml'
+    else:
+        bindings['__output_format__'] = output_format
 
     current_file = bindings['__FILE__'] # Remember prior file
     if current_file == None:
@@ -807,6 +2949,8 @@ def expand_file(filename, bindings, expandafterload=True, outputfile=None):
         path = os.path.abspath(os.path.join(current_dir, filename)) # resolve relative paths
     if expandafterload:
         bindings['__FILE__'] = path # New file now
+    if dependencies is not None:
+        dependencies.file(path)
 
     # Do the load/parse
     result = file_types[suffix]()
@@ -814,23 +2958,478 @@ def expand_file(filename, bindings, expandafterload=True, outputfile=None):
     return result
 
 
-def new_globals():
+def new_globals(argv=None):
     """
     Construct a new Yamp environment of globals.
+    :param argv: command line arguments visible to templates as 'argv', defaults to sys.argv
     :return: New global dict
     """
-    global_environment = {'__FILE__': None, 'argv' : sys.argv, 'env': os.environ.copy()}
+    if argv is None:
+        argv = sys.argv
+    global_environment = Scope(bindings={'__FILE__': None, 'argv' : argv, 'env': os.environ.copy()})
     add_builtins_to_env(global_environment)    
     return global_environment
 
 
-if __name__ == '__main__':
+def argument_parser(prog):
+    """
+    :return: the argparse parser of the command line, see parse_arguments
+    """
+    parser = argparse.ArgumentParser(prog=prog, description='Expand a YAML file with yamp macros.')
+    parser.add_argument('--stream', action='store_true',
+                        help='write each document as soon as it is expanded instead of after the whole file')
+    parser.add_argument('--output-format', choices=sorted(DOCUMENT_WRITERS.keys()), default='yaml',
+                        help='write the documents as YAML, as JSON or as one line of JSON each')
+    parser.add_argument('--jobs', type=int, default=1, metavar='N',
+                        help='expand the documents which follow the last define, defmacro or include in N processes, '
+                             'or in batch mode expand N files at a time')
+    parser.add_argument('--batch', action='store_true',
+                        help='the filename and arguments are INPUT:OUTPUT pairs of files to expand in turn')
+    parser.add_argument('--manifest', metavar='FILE',
+                        help='expand the INPUT:OUTPUT pairs listed one per line in FILE')
+    parser.add_argument('--server', metavar='SOCKET',
+                        help='listen for yamp_client.py requests on the Unix socket SOCKET')
+    parser.add_argument('--profile', action='store_true',
+                        help='report the calls and time of each macro and builtin to the standard error')
+    parser.add_argument('--profile-output', metavar='FILE', help='write the --profile report to FILE')
+    parser.add_argument('--profile-sort', choices=Profiler.SORT_KEYS, default='exclusive',
+                        help='order the --profile report by name or by the largest calls, times or argument size, default exclusive')
+    parser.add_argument('--profile-format', choices=['text', 'json'], default='text',
+                        help='write the --profile report as a text table or as JSON')
+    parser.add_argument('--trace', metavar='FILE',
+                        help='write a JSON line to FILE for each expansion, macro call and file, see fold_trace.py')
+    parser.add_argument('--watch', action='store_true',
+                        help='expand the files, then expand each again whenever a file it used changes, until interrupted')
+    parser.add_argument('--cache-dir', metavar='DIR', default=os.environ.get('YAMP_CACHE_DIR'),
+                        help='keep parsed files in DIR between runs, default $YAMP_CACHE_DIR')
+    parser.add_argument('--cache-results', action='store_true',
+                        help='keep the output in the --cache-dir and reuse it while the files and env variables used are unchanged')
+    parser.add_argument('--cache-clear', action='store_true', help='empty the --cache-dir')
+    parser.add_argument('--cache-stats', action='store_true', help='report the size and use of the --cache-dir')
+    parser.add_argument('--engine', choices=sorted(ENGINES.keys()), default='recursive',
+                        help='expand with recursive Python calls, or with an explicit stack for deeply nested trees and macro calls')
+    parser.add_argument('--yaml-backend', choices=['auto', 'c', 'python'], default='auto',
+                        help='parse and write YAML with the libyaml C extension or with Python, by default libyaml if installed')
+    parser.add_argument('--output', metavar='FILE', help='write the expansion to FILE instead of the standard output')
+    parser.add_argument('--depfile', metavar='FILE',
+                        help='write the files, env keys and argv indexes the expansion used to FILE')
+    parser.add_argument('--depfile-format', choices=['make', 'json'], default='make',
+                        help='write the --depfile as a Makefile rule for the --output, also read by Ninja, or as JSON')
+    parser.add_argument('filename', nargs='?', help='the file to expand')
+    parser.add_argument('args', nargs=argparse.REMAINDER, help='arguments available to the template in argv')
+    return parser
+
+def parse_arguments(argv):
+    """
+    Parse the command line. Options must come before the filename, everything after it is passed to the template.
+    :param argv: full command line including the program name
+    :return: argparse Namespace
+    """
+    parser = argument_parser(os.path.basename(argv[0]))
+    options = parser.parse_args(argv[1:])
+    if options.jobs < 1:
+        parser.error('--jobs must be at least 1')
+    if (options.cache_clear or options.cache_stats) and not options.cache_dir:
+        parser.error('--cache-clear and --cache-stats need a --cache-dir')
+    if options.cache_results and not options.cache_dir:
+        parser.error('--cache-results needs a --cache-dir')
+    if options.filename is None and not (options.manifest or options.server or options.cache_clear or options.cache_stats):
+        parser.error('no files to scan')
+    if options.filename and options.manifest and not options.batch:
+        parser.error('use --batch to add INPUT:OUTPUT pairs to a --manifest')
+    if (options.output or options.depfile or options.cache_results) and (options.batch or options.manifest or options.server):
+        parser.error('--output, --depfile and --cache-results are for a single file, not --batch, --manifest or --server')
+    if options.watch and (options.server or options.depfile or options.cache_results or options.filename == '-'):
+        parser.error('--watch cannot be used with --server, --depfile, --cache-results or the standard input')
+    if options.depfile and options.depfile_format == 'make' and not options.output:
+        parser.error('--depfile-format make needs an --output as the target')
+    return options
+
+
+def parse_pair(text, directory=''):
+    """
+    Split a batch specification 'input:output' into a pair of paths, relative to directory. An output of '-' is the standard output.
+    :return: (input, output)
+    """
+    if ':' not in text:
+        raise(YampException('Batch file "{}" is not of the form INPUT:OUTPUT'.format(text)))
+    input_file, output_file = text.rsplit(':', 1)
+    if not input_file or not output_file:
+        raise(YampException('Batch file "{}" is not of the form INPUT:OUTPUT'.format(text)))
+    if input_file != '-':
+        input_file = os.path.join(directory, input_file)
+    if output_file != '-':
+        output_file = os.path.join(directory, output_file)
+    return input_file, output_file
+
+def read_manifest(manifest):
+    """
+    Read a batch manifest with one 'input:output' pair per line. Blank lines and lines starting with '#' are ignored.
+    Paths are relative to the manifest's directory.
+    :return: list of (input, output)
+    """
+    directory = os.path.dirname(manifest)
+    with open(manifest) as fd:
+        return [parse_pair(line.strip(), directory) for line in fd if line.strip() and not line.strip().startswith('#')]
+
+def expand_batch_file(pair, argv0='yamp', stream=False, output_format='yaml', argv=None):
+    """
+    Expand one input file to its output file in a new global environment.
+    :param argv: command line arguments visible to the template, defaults to the program name and input file
+    :return: exit status, 0 for success
+    """
+    input_file, output_file = pair
+    try:
+        outputfile = sys.stdout if output_file == '-' else open(output_file, 'w')
+        try:
+            expand_file(input_file, new_globals(argv or [argv0, input_file]), expandafterload=True,
+                        outputfile=outputfile, stream=stream, jobs=1, output_format=output_format)
+        finally:
+            if outputfile is not sys.stdout:
+                outputfile.close()
+    except SystemExit as e:
+        return e.code
+    except IOError as e:
+        print('ERROR: {}\n{}\n'.format(output_file, e), file=sys.stderr)
+        return 1
+    return 0
+
+def expand_batch(pairs, argv0='yamp', stream=False, jobs=1, output_format='yaml'):
+    """
+    Expand many files in this process, so they share the parsing, template and compiled body caches.
+    Each file has its own global environment. With more than one job the files are shared between
+    that many worker processes. An error in one file does not stop the others.
+    :param pairs: list of (input, output) file names
+    :return: the number of files which failed
+    """
+    iteration = lambda pair: expand_batch_file(pair, argv0, stream, output_format)
+    outcomes = None
+    if jobs > 1 and len(pairs) > 1 and can_fork():
+        outcomes = parallel_map(iteration, pairs, jobs)
+    if outcomes is None:
+        outcomes = [(True, iteration(pair)) for pair in pairs]
+    failures = 0
+    for ok, outcome in outcomes:
+        if not ok or outcome:
+            failures += 1
+    return failures
+
+WATCH_INTERVAL = 0.05 # Seconds between checks of the watched files
+
+class WatchedFiles(Dependencies):
+    """
+    Dependencies which note the version of each file in the watcher as the file is first used, before it is read.
+    """
+    def __init__(self, watcher):
+        Dependencies.__init__(self, {}, [])
+        self.watcher = watcher
+
+    def file(self, path):
+        if path != '-' and path not in self.watcher.versions:
+            self.watcher.versions[path] = self.watcher.version(path)
+        Dependencies.file(self, path)
+
+class Watcher(object):
+    """
+    Expand files, then expand each again whenever any of the files it used changes. The files are polled,
+    so any file system will do. The parse, template and compiled body caches stay in memory between
+    expansions, so only the changed files are parsed again.
+    """
+    def __init__(self, targets, stream=False, output_format='yaml'):
+        """
+        :param targets: list of (input, output, argv) to expand, an output of '-' is the standard output
+        """
+        self.targets = targets
+        self.stream = stream
+        self.output_format = output_format
+        self.files = [[] for target in targets] # The files each target used
+        self.versions = {} # path -> (mtime, size, inode), or None if missing
+
+    def version(self, path):
+        try:
+            statinfo = os.stat(path)
+        except OSError:
+            return None
+        return (statinfo.st_mtime, statinfo.st_size, statinfo.st_ino)
+
+    def expand(self, index):
+        """
+        Expand a target, recording the files it used. A file is remembered as it was before the first
+        expansion which used it, so a change during an expansion is seen by the next poll.
+        :return: exit status
+        """
+        global dependencies
+        input_file, output_file, argv = self.targets[index]
+        dependencies = WatchedFiles(self) # Only the files are watched
+        try:
+            status = expand_batch_file((input_file, output_file), stream=self.stream,
+                                       output_format=self.output_format, argv=argv)
+            self.files[index] = [path for path in dependencies.files if path != '-']
+        finally:
+            dependencies = None
+        for path in self.files[index]: # Those used only by worker processes
+            if path not in self.versions:
+                self.versions[path] = self.version(path)
+        return status
+
+    def start(self):
+        """
+        Expand all the targets.
+        :return: list of exit statuses
+        """
+        return [self.expand(index) for index in range(len(self.targets))]
 
-    if len(sys.argv) < 2:
+    def poll(self):
+        """
+        Expand again each target which used a file that has changed since the last poll.
+        :return: list of the indexes of the targets expanded
+        """
+        changed = set()
+        for path, version in self.versions.items():
+            current = self.version(path)
+            if current != version:
+                self.versions[path] = current
+                changed.add(path)
+        affected = [index for index, files in enumerate(self.files) if changed.intersection(files)]
+        for index in affected:
+            self.expand(index)
+        return affected
+
+    def run(self, interval=WATCH_INTERVAL):
+        """
+        Expand all the targets, then poll every interval seconds until interrupted.
+        """
+        self.start()
+        try:
+            while True:
+                time.sleep(interval)
+                started = time.time()
+                affected = self.poll()
+                if affected:
+                    print('Yamp: expanded {} in {:.0f} ms'.format(
+                        ' '.join(self.targets[index][0] for index in affected), (time.time() - started) * 1000),
+                        file=sys.stderr)
+        except KeyboardInterrupt:
+            pass
+
+def serve_request(request, argv0='yamp'):
+    """
+    Run a client's request as if yamp was run with its command line, in its directory and environment and with its standard input.
+    :param request: {'argv': [options, filename, args...], 'cwd': <directory>, 'env': <map>, 'stdin': <text>}
+    :param argv0: program name to use for argv.0
+    :return: {'status': <exit status>, 'output': <standard output>, 'error': <standard error>}
+    """
+    saved = (sys.stdin, sys.stdout, sys.stderr, os.environ, os.getcwd())
+    output = StringIO.StringIO()
+    error = StringIO.StringIO()
+    status = 0
+    try:
+        sys.stdin = StringIO.StringIO(request.get('stdin') or '')
+        sys.stdout = output
+        sys.stderr = error
+        os.environ = dict(request.get('env') or saved[3])
+        os.chdir(request.get('cwd') or saved[4])
+        argv = [argv0] + list(request.get('argv') or [])
+        options = parse_arguments(argv) if len(argv) > 1 else None
+        if options is not None and (options.server or options.watch):
+            print('ERROR: {} cannot be used by a client'.format('--server' if options.server else '--watch'),
+                  file=sys.stderr)
+            status = 1
+        else:
+            main(argv)
+    except SystemExit as e:
+        if e.code is None or type(e.code) == int:
+            status = e.code or 0
+        else:
+            print(e.code, file=sys.stderr)
+            status = 1
+    except Exception as e:
+        print('ERROR: {}\n{}\n'.format(type(e), e), file=sys.stderr)
+        status = 1
+    finally:
+        sys.stdin, sys.stdout, sys.stderr, os.environ = saved[:4]
+        os.chdir(saved[4])
+    return {'status': status, 'output': output.getvalue(), 'error': error.getvalue()}
+
+class ServerHandler(SocketServer.StreamRequestHandler):
+    """
+    Read one JSON request line from a client, run it and write back one JSON response line.
+    """
+    def handle(self):
+        try:
+            request = byteify(json.loads(self.rfile.readline()))
+            if type(request) != dict:
+                raise(ValueError('request is not a map'))
+        except ValueError as e:
+            response = {'status': 1, 'output': '', 'error': 'ERROR: bad request {}\n'.format(e)}
+        else:
+            response = serve_request(request, self.server.argv0)
+        self.wfile.write(json.dumps(response) + '\n')
+
+def serve(socket_path, argv0='yamp'):
+    """
+    Listen on a Unix socket and run the requests of clients one at a time until interrupted. Parsed files,
+    templates and compiled bodies stay in memory between requests. Parsed files are read again when they change.
+    The disk_cache, if any, is kept for the requests which do not give their own --cache-dir.
+    :param socket_path: file name of the socket, replaced if it exists
+    :param argv0: program name to use for argv.0
+    """
+    global server_disk_cache
+    server_disk_cache = disk_cache
+    if os.path.exists(socket_path) and stat.S_ISSOCK(os.stat(socket_path).st_mode):
+        os.remove(socket_path)
+    server = SocketServer.UnixStreamServer(socket_path, ServerHandler)
+    server.argv0 = argv0
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(socket_path)
+
+
+class TeeFile(object):
+    """
+    Output file which also keeps a copy of everything written to it.
+    """
+    def __init__(self, outputfile):
+        self.outputfile = outputfile
+        self.copy = StringIO.StringIO()
+
+    def write(self, text):
+        self.outputfile.write(text)
+        self.copy.write(text)
+
+    def flush(self):
+        self.outputfile.flush()
+
+def expand_single_file(options, template_argv):
+    """
+    Expand the file named on the command line to the --output or the standard output,
+    then write the --depfile if asked. With --cache-results the output is taken from the
+    disk_cache if none of the inputs it used have changed.
+    """
+    global dependencies
+    bindings = new_globals(template_argv)
+    cache_results = options.cache_results and options.filename != '-'
+    if options.depfile or cache_results:
+        dependencies = Dependencies(bindings['env'], bindings['argv'])
+    try:
+        try:
+            outputfile = open(options.output, 'w') if options.output else sys.stdout
+        except IOError as e:
+            print('ERROR: {}\n{}\n'.format(options.output, e), file=sys.stderr)
+            sys.exit(1)
+        try:
+            entry = None
+            if cache_results:
+                key = disk_cache.result_key(options.filename, template_argv,
+                                            [options.stream, options.output_format])
+                entry = disk_cache.result(key, bindings['env'])
+            if entry is not None:
+                outputfile.write(entry['output'])
+                dependencies.merge(entry['records'])
+            elif cache_results:
+                tee = TeeFile(outputfile)
+                expand_file(options.filename, bindings, expandafterload=True,
+                            outputfile=tee, stream=options.stream, jobs=options.jobs,
+                            output_format=options.output_format)
+                if dependencies.deterministic and '-' not in dependencies.files:
+                    disk_cache.put_result(key, dependencies, tee.copy.getvalue())
+            else:
+                expand_file(options.filename, bindings, expandafterload=True,
+                            outputfile=outputfile, stream=options.stream, jobs=options.jobs,
+                            output_format=options.output_format)
+        finally:
+            if outputfile is not sys.stdout:
+                outputfile.close()
+        if options.depfile:
+            if options.depfile_format == 'make':
+                text = dependencies.as_make(options.output)
+            else:
+                text = dependencies.as_json(options.output)
+            try:
+                with open(options.depfile, 'w') as fd:
+                    fd.write(text)
+            except IOError as e:
+                print('ERROR: {}\n{}\n'.format(options.depfile, e), file=sys.stderr)
+                sys.exit(1)
+    finally:
+        dependencies = None
+
+
+def write_profile(options):
+    """
+    Write the profiler's report to the --profile-output file, or to the standard error.
+    """
+    report = profiler.report(options.profile_sort, options.profile_format)
+    if not options.profile_output:
+        sys.stderr.write(report)
+        return
+    try:
+        with open(options.profile_output, 'w') as fd:
+            fd.write(report)
+    except IOError as e:
+        print('ERROR: {}\n{}\n'.format(options.profile_output, e), file=sys.stderr)
+
+
+def main(argv):
+    if len(argv) < 2:
         print('ERROR: no files to scan', file=sys.stderr)
         sys.exit(1)
 
-    filename  = sys.argv[1]
-    expand_file(filename, new_globals(), expandafterload=True, outputfile=sys.stdout)
+    options = parse_arguments(argv)
+    try:
+        set_yaml_backend(options.yaml_backend)
+    except YampException as e:
+        print('ERROR: {}'.format(e), file=sys.stderr)
+        sys.exit(1)
+    set_engine(options.engine)
+    global disk_cache, profiler
+    disk_cache = DiskCache(os.path.abspath(options.cache_dir)) if options.cache_dir else server_disk_cache
+    profiler = Profiler() if options.profile or options.profile_output else None
+    trace_file = None
+    if options.trace:
+        try:
+            trace_file = open(options.trace, 'w')
+        except IOError as e:
+            print('ERROR: {}\n{}\n'.format(options.trace, e), file=sys.stderr)
+            sys.exit(1)
+        set_tracer(lambda event: trace_file.write(json.dumps(event) + '\n'))
+    if options.cache_clear:
+        disk_cache.clear()
+    try:
+        if options.server:
+            serve(options.server, argv[0])
+        elif options.batch or options.manifest:
+            try:
+                pairs = read_manifest(options.manifest) if options.manifest else []
+                if options.batch and options.filename:
+                    pairs += [parse_pair(text) for text in [options.filename] + options.args]
+            except (YampException, IOError) as e:
+                print('ERROR: {}'.format(e), file=sys.stderr)
+                sys.exit(1)
+            if options.watch:
+                Watcher([(input_file, output_file, [argv[0], input_file]) for input_file, output_file in pairs],
+                        options.stream, options.output_format).run()
+            else:
+                sys.exit(1 if expand_batch(pairs, argv[0], options.stream, options.jobs, options.output_format) else 0)
+        elif options.watch:
+            Watcher([(options.filename, options.output or '-', [argv[0], options.filename] + options.args)],
+                    options.stream, options.output_format).run()
+        elif options.filename is not None:
+            expand_single_file(options, [argv[0], options.filename] + options.args)
+    finally:
+        if options.cache_stats:
+            print(disk_cache.stats(), file=sys.stderr)
+        if profiler is not None:
+            write_profile(options)
+            profiler = None
+        if trace_file is not None:
+            set_tracer(None)
+            trace_file.close()
 
 
+if __name__ == '__main__':
+    main(sys.argv)
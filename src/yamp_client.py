@@ -0,0 +1,87 @@
+#!/bin/env python
+"""
+ Client for a yamp server, which saves the Python start-up and parsing time of each run.
+ Behaves the same as 'python yamp.py', sending the command line, current directory,
+ environment and standard input to the server and writing out its reply.
+
+ Start the server with:
+
+      python2 yamp.py --server /tmp/yamp.sock &
+
+ Usage:
+
+      YAMP_SOCKET=/tmp/yamp.sock python2 yamp_client.py [options] [Filename | - ] [arg1..argn]
+
+ If YAMP_SOCKET is not set or no server is listening, the file is expanded in this process.
+"""
+from __future__ import print_function
+
+import os
+import sys
+import json
+import socket
+
+# The options of yamp.py which take a value, as in its argument_parser()
+VALUE_OPTIONS = set(['--cache-dir', '--depfile', '--depfile-format', '--engine', '--jobs', '--manifest', '--output',
+                     '--output-format', '--profile-format', '--profile-output', '--profile-sort', '--server', '--trace',
+                     '--yaml-backend'])
+
+
+def input_filename(argv):
+    """
+    :return: the filename in a yamp.py command line, the first argument which is not an option or the value of
+             one, or None if there is none
+    """
+    args = iter(argv)
+    for arg in args:
+        if arg == '--':
+            return next(args, None)
+        if arg == '-' or not arg.startswith('-'):
+            return arg
+        if arg in VALUE_OPTIONS:
+            next(args, None)
+    return None
+
+
+def request(socket_path, argv):
+    """
+    Send a command line to the server and return its reply.
+    :return: {'status': <exit status>, 'output': <standard output>, 'error': <standard error>}
+    """
+    message = {'argv': argv, 'cwd': os.getcwd(), 'env': dict(os.environ)}
+    if input_filename(argv) == '-':
+        message['stdin'] = sys.stdin.read()
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    connection.connect(socket_path)
+    try:
+        connection.sendall(json.dumps(message) + '\n')
+        reply = []
+        while True:
+            data = connection.recv(65536)
+            if not data:
+                break
+            reply.append(data)
+    finally:
+        connection.close()
+    return json.loads(''.join(reply))
+
+
+def run_locally(argv):
+    sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)))
+    import yamp
+    yamp.main([os.path.join(os.path.dirname(sys.argv[0]), 'yamp.py')] + argv)
+
+
+if __name__ == '__main__':
+    socket_path = os.environ.get('YAMP_SOCKET')
+    if not socket_path:
+        run_locally(sys.argv[1:])
+        sys.exit(0)
+    try:
+        reply = request(socket_path, sys.argv[1:])
+    except socket.error:
+        run_locally(sys.argv[1:])
+        sys.exit(0)
+    sys.stdout.write(reply['output'].encode('utf-8'))
+    sys.stderr.write(reply['error'].encode('utf-8'))
+    sys.exit(reply['status'])
@@ -4,6 +4,7 @@ import StringIO
 import unittest
 import filecmp
 import tempfile
+import shutil
 from pprint import pprint
 
 curr_path = os.path.dirname(os.path.realpath(__file__))
@@ -207,6 +208,20 @@ class TestYamp(unittest.TestCase):
                 {'maco': {'p1': 1, 'p2': 2}, 'extra': 2}], {})
         self.assertTrue('too many keys in macro' in context.exception.message)
 
+    def testMacroKeys(self):
+        tree = load('''
+- defmacro: {name: maco, args: [p], value: [p]}
+- define: {alias: maco, lib: {m: maco}, items: {quote: ["{{undefined}}"]}}
+- {items: 1, other: 2}
+''', Loader=Loader)
+        # A key bound to a list is not expanded to find out if it is a macro
+        self.assertEquals([{'items': 1, 'other': 2}], expand(tree, new_globals()))
+        for call in ['{other: 1, maco: {p: 1}}', '{other: 1, alias: {p: 1}}', '{other: 1, lib.m: {p: 1}}']:
+            tree[2] = load(call, Loader=Loader)
+            with self.assertRaises(YampException) as context:
+                expand(tree, new_globals())
+            self.assertTrue('too many keys in macro' in context.exception.message)
+
     def testMacroBadArgs(self):
         with self.assertRaises(Exception) as context:
             expand([
@@ -314,6 +329,58 @@ class TestYamp(unittest.TestCase):
                         {'inner': None}, 'y']}},
                 {'outer': {'y': 42}}], {'x': 33, 'y': 34}))
 
+    def testMacroMemoize(self):
+        env = new_globals()
+        real_expand([
+            {'define': {'url': 'http://git'}},
+            {'defmacro': {'name': 'mat', 'args': ['b'], 'memoize': True,
+                          'value': {'git': 'url', 'branch': 'b'}}}], env)
+        cache = env['mat'][1].cache
+        result = real_expand({'repeat': {'for': 'i', 'in': [1, 2, 1, 1], 'body': {'mat': {'b': 'i'}}}}, env)
+        self.assertEquals([{'git': 'http://git', 'branch': 1}, {'git': 'http://git', 'branch': 2},
+                           {'git': 'http://git', 'branch': 1}, {'git': 'http://git', 'branch': 1}], result)
+        self.assertEquals((2, 2), (cache.hits, cache.misses))
+        real_expand({'mat': {'b': True}}, env)
+        self.assertEquals((2, 3), (cache.hits, cache.misses))
+        real_expand({'define': {'url': 'http://other'}}, env)
+        self.assertEquals({'git': 'http://other', 'branch': 1}, real_expand({'mat': {'b': 1}}, env))
+
+    def testMacroMemoizeImpure(self):
+        env = new_globals()
+        real_expand([
+            {'defmacro': {'name': 'impure', 'args': [], 'memoize': True,
+                          'value': {'python_eval': '1'}}},
+            {'defmacro': {'name': 'forced', 'args': [], 'memoize': 'force',
+                          'value': {'python_eval': '1'}}},
+            {'defmacro': {'name': 'plain', 'args': [], 'value': 1}}], env)
+        self.assertEquals(None, env['impure'][1].cache)
+        self.assertEquals(None, env['plain'][1].cache)
+        self.assertEquals([1, 1], real_expand([{'forced': None}, {'forced': None}], env))
+        self.assertEquals(1, env['forced'][1].cache.hits)
+        with self.assertRaises(YampException) as context:
+            real_expand({'defmacro': {'name': 'bad', 'args': [], 'memoize': 'yes', 'value': 1}}, env)
+        self.assertTrue('memoize' in context.exception.message)
+
+    def testMacroMemoizeCallsImpure(self):
+        env = new_globals()
+        real_expand([
+            {'defmacro': {'name': 'roll', 'args': [], 'value': {'python_eval': '__import__("random").random()'}}},
+            {'defmacro': {'name': 'outer', 'args': ['x'], 'memoize': True, 'value': [{'roll': None}]}}], env)
+        first, second = real_expand([{'outer': {'x': 1}}, {'outer': {'x': 1}}], env)
+        self.assertNotEquals(first, second)
+        self.assertEquals(0, env['outer'][1].cache.hits)
+        # Once the macro it calls is redefined to be pure, the results are cached
+        real_expand({'defmacro': {'name': 'roll', 'args': [], 'value': 4}}, env)
+        self.assertEquals([[4], [4]], real_expand([{'outer': {'x': 1}}, {'outer': {'x': 1}}], env))
+        self.assertEquals(1, env['outer'][1].cache.hits)
+
+    def testCanonical(self):
+        self.assertEquals(canonical({'a': [1, {'b': 2}]}), canonical({'a': [1, {'b': 2}]}))
+        self.assertNotEquals(canonical([1]), canonical([True]))
+        self.assertNotEquals(canonical({'a': 1}), canonical([('a', 1)]))
+        with self.assertRaises(TypeError):
+            canonical(set([1]))
+
     def testSubVarExactFirst(self):
         global_env = {'l0sub.l1sub.l2': 'takes precedence',
                        'l0sub.l1sub.': 99, 
@@ -383,6 +450,64 @@ class TestYamp(unittest.TestCase):
         self.assertEquals('epresley', expand('env.USERNAME', fake_global))
         self.assertEquals('testReflection', expand('__FILE__', fake_global))
 
+    def testScopeLookup(self):
+        top = Scope(bindings={'a': 1})
+        scope = top
+        for depth in range(100):
+            scope = Scope(scope, {'level': depth})
+        self.assertEquals((1, True), lookup(scope, 'a'))
+        self.assertEquals((None, False), lookup(scope, 'b'))
+        self.assertEquals((99, True), lookup(scope, 'level'))
+        top['a'] = 2
+        top['b'] = 3
+        self.assertEquals([(2, True), (3, True)], [lookup(scope, 'a'), lookup(scope, 'b')])
+        del top['b']
+        self.assertEquals((None, False), lookup(scope, 'b'))
+        self.assertTrue(lookup(scope, '__parent__')[0] is scope.parent)
+
+    def testScopePlainDictParent(self):
+        root = {'a': 1}
+        scope = Scope(Scope(root))
+        self.assertEquals((1, True), lookup(scope, 'a'))
+        root['a'] = 2
+        self.assertEquals((2, True), lookup(scope, 'a'))
+        self.assertEquals(2, Env(scope)['a'])
+
+    def testScopeSnapshot(self):
+        top = Scope(bindings={'a': 1, 'b': 1})
+        scope = Scope(top, {'b': 2})
+        flat = scope.snapshot()
+        top['a'] = 99
+        self.assertEquals({'a': 1, 'b': 2}, flat)
+        self.assertEquals(None, flat.parent)
+
+    def testParentVariable(self):
+        self.assertEquals(['x'], expand([
+            {'define': {'name': 'who', 'value': 'x'}},
+            {'defmacro': {'name': 'm', 'args': None,
+                          'value': {'python_eval': 'lookup(__parent__, "who")[0]'}}},
+            {'m': None}], {}))
+
+    def testCompiledTree(self):
+        env = new_globals()
+        env.update({'A': 1, 'B': 'A', 'C': {'D': [3, 4]}, 'K': 'key', 'N': None})
+        real_expand([{'defmacro': {'name': 'mac', 'args': ['x'], 'value': {'got': 'x'}}}], env)
+        for tree in ['A', 'B', 'C.D.1', 'Z', 'Z.Y', ' {{A}} {{C.D}}', '{{A', 123, None, [1, 'A', 'N', None],
+                     {'k{{A}}': 'B', '^K': 'C', 'plain': ['A']}, {'mac': {'x': 'C.D'}}, {'A': 'B'},
+                     {'if': {'==': ['A', 1]}, 'then': 'B', 'else': 'C'}, {'quote': {'mac': 'A'}}, {},
+                     {'repeat': {'for': 'i', 'in': {'range': [1, 3]}, 'body': {'v{{i}}': 'i'}}},
+                     {'if': True, 'then': ['B', {'quote': 'B'}]}, {'if': {'==': [{'quote': 'x'}, 'x']}, 'then': 'B'},
+                     {'if': False, 'then': 1}, {'repeat': {'for': 'i', 'in': [1, 2], 'key': 'k{{i}}', 'body': 'B'}}]:
+            self.assertEquals(real_expand(tree, env), compile_tree(tree)(env))
+            self.assertEquals(real_expand(tree, env), evaluate(tree, env))
+        for tree in [{'mac': None, 'A': 1}, {'{{A}}': 1, '1': 2}, {'^Q': 1}, '{{Q}}', 'C.Q', {'if': 2, 'then': 1},
+                     {'if': True, 'then': 1, 'x': 2}, {'if': True}]:
+            with self.assertRaises(YampException) as expected:
+                real_expand(tree, env)
+            with self.assertRaises(YampException) as context:
+                compile_tree(tree)(env)
+            self.assertEquals(expected.exception.message, context.exception.message)
+
     def testStringInterpolation(self):
         bindings = {'A': 1, 'B' : 2, 'C' : { 'D' : 3}}
         self.assertEquals('', interpolate('', bindings))
@@ -395,6 +520,49 @@ class TestYamp(unittest.TestCase):
         self.assertEquals("A = 1 B = 2 C = {'D': 3}", interpolate('A = {{A}} B = {{B}} C = {{C}}', bindings))
         self.assertEquals("A = 1 C.D = 3", interpolate('A = {{A}} C.D = {{C.D}}', bindings))
 
+    def testStringInterpolationTemplateCache(self):
+        template_cache.clear()
+        bindings = {'A': 1, 'B': 2}
+        self.assertEquals('plain', interpolate('plain', bindings))
+        self.assertEquals(0, len(template_cache))
+        self.assertEquals('A = 1', interpolate('A = {{A}}', bindings))
+        self.assertEquals('A = 2', interpolate('A = {{A}}', {'A': 2}))
+        self.assertEquals((1, 1), (template_cache.misses, template_cache.hits))
+        template = compile_template('{{A}}-{{ B }}')
+        self.assertEquals((('A', None), (None, '-'), ('B', None), (None, '')), template.parts[1:])
+        self.assertTrue(compile_template('{{A') is None)
+
+    def testLRUCache(self):
+        cache = LRUCache(2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        self.assertEquals(1, cache.get('a'))
+        cache.put('c', 3)
+        self.assertEquals(None, cache.get('b'))
+        self.assertEquals([1, 3], [cache.get('a'), cache.get('c')])
+        cache = LRUCache(10)
+        cache.put('a', 1, 4)
+        cache.put('b', 2, 4)
+        cache.get('a')
+        cache.put('c', 3, 4)
+        self.assertEquals([1, None, 3], [cache.get('a'), cache.get('b'), cache.get('c')])
+        self.assertEquals(8, cache.size)
+        cache.put('d', 4, 20) # Too big, empties the cache
+        self.assertEquals((['d'], 20), (cache.entries.keys(), cache.size))
+
+    def testParseCache(self):
+        source = tempfile.mkstemp(suffix='.json')
+        os.write(source[0], '{"a": [1, 2]}')
+        os.close(source[0])
+        first = parse_file(source[1], read_json_documents)
+        self.assertEquals([{'a': [1, 2]}], first)
+        self.assertTrue(parse_file(source[1], read_json_documents) is first)
+        self.assertTrue(expand({'load': source[1]}, {'__current_output__': StringIO.StringIO()})['a'] is not first[0]['a']) # Expansion copies the shared tree
+        with open(source[1], 'w') as fd:
+            fd.write('{"a": [1, 2, 3]}')
+        self.assertEquals([{'a': [1, 2, 3]}], parse_file(source[1], read_json_documents))
+        os.remove(source[1])
+
     def testStringInterpolationExpansion(self):
         bindings = {'A': 1, 'B' : 2, 'C' : { 'D' : 3}}
         self.assertEquals(' 1 ', expand(' {{A}} ', bindings))
@@ -538,6 +706,45 @@ class TestYamp(unittest.TestCase):
                           ['hello mum', 'iteration 2 b']]}
         self.assertEquals(expected, expand(expression, bindings))
 
+    def testRepeatParallel(self):
+        bindings = {'A': 1}
+        for key in [None, 'K{{loop_variable}}']:
+            expression = {'repeat':{
+                'for': 'loop_variable',
+                'in': {'range': [1, 20]},
+                'body': ['hello mum', 'iteration {{ loop_variable }}', {'==': ['loop_variable', 'A']}]
+                }}
+            if key:
+                expression['repeat']['key'] = key
+            sequential = expand(expression, bindings)
+            expression['repeat']['parallel'] = 3
+            self.assertEquals(sequential, expand(expression, bindings))
+        with self.assertRaisesRegexp(YampException, 'duplication'):
+            expand({'repeat': {'for': 'v', 'in': [1, 2, 1], 'key': 'K{{v}}', 'body': 'v', 'parallel': 2}}, {})
+        with self.assertRaisesRegexp(YampException, 'Undefined interpolation variable "j"'):
+            expand({'repeat': {'for': 'v', 'in': [1, 2], 'body': ['v', '{{j}}'], 'parallel': 2}}, {})
+        with self.assertRaisesRegexp(YampException, 'parallel'):
+            expand({'repeat': {'for': 'v', 'in': [1, 2], 'body': 'v', 'parallel': 'lots'}}, {})
+        # Defines in the body carry over to later iterations, so it runs sequentially
+        self.assertEquals([[], [1]], expand({'repeat': {'for': 'v', 'in': [1, 2], 'parallel': 2,
+            'body': {'flatten': ['prev', {'define': {'prev': 'v'}}]}}}, {'prev': None}))
+
+    def testSideEffectFree(self):
+        env = new_globals()
+        real_expand({'defmacro': {'name': 'pure', 'args': [], 'value': ['x']}}, env)
+        real_expand({'defmacro': {'name': 'impure', 'args': [], 'value': {'define': {'x': 1}}}}, env)
+        real_expand({'defmacro': {'name': 'calls_impure', 'args': [], 'value': [{'impure': None}]}}, env)
+        self.assertTrue(side_effect_free(['x', {'pure': None}, {'python_eval': '1'}], env, set()))
+        self.assertFalse(side_effect_free([{'define': {'x': 1}}], env, set()))
+        self.assertFalse(side_effect_free({'a': {'include': ['f.yaml']}}, env, set()))
+        self.assertFalse(side_effect_free({'^x': 1}, env, set()))
+        self.assertFalse(side_effect_free([{'calls_impure': None}], env, set()))
+        # A builtin bound to another name is still the builtin
+        real_expand({'define': {'inc': 'include', 'evaluate': 'python_eval'}}, env)
+        self.assertFalse(side_effect_free({'a': {'inc': ['f.yaml']}}, env, set()))
+        self.assertTrue(side_effect_free({'evaluate': '1'}, env, set()))
+        self.assertTrue(calls_forms({'evaluate': '1'}, env, IMPURE_FORMS, set()))
+
     def testPython(self):
         bindings = {'A': 1, 'B' : 2}
         self.assertEquals([1, 2], expand({'python_eval': '[A, B]'}, bindings))
@@ -681,6 +888,33 @@ class TestYamp(unittest.TestCase):
     def test_range_builtin_ok(self):
         self.assertEquals([3,2,1],range_builtin({ "range:" : [3,1]}, [3,1], {}))
 
+    def testRangeLazy(self):
+        big = range_builtin({'range': [1, 10**9]}, [1, 10**9], {})
+        self.assertEqual(type(big), Range)
+        self.assertEqual(len(big), 10**9)
+        self.assertEqual(big[-1], 10**9)
+        self.assertTrue(500 in big)
+        self.assertEqual(big, Range(1, 10**9))
+        self.assertNotEqual(big, [1, 2])
+        self.assertTrue(expand('r', {'r': big}) is big)
+        self.assertEqual(expand('r.2', {'r': big}), 3)
+        self.assertEqual(expand('{{r}}', {'r': Range(1, 3)}), '[1, 2, 3]')
+        self.assertEqual(expand({'==': ['r', [3, 2, 1]]}, {'r': Range(3, 1)}), True)
+        self.assertEqual(expand({'flatten': ['r', ['r']]}, {'r': Range(1, 2)}), [1, 2, 1, 2])
+        self.assertEqual(expand({'flatone': ['r', ['r']]}, {'r': Range(1, 2)}), [1, 2, [1, 2]])
+        self.assertEqual(expand({'repeat': {'for': 'i', 'in': 'r', 'body': 'x{{i}}'}}, {'r': Range(1, 2)}), ['x1', 'x2'])
+        self.assertEqual(dump([Range(1, 2), Range(1, 2)], Dumper=YampDumper, default_flow_style=False),
+                         '- - 1\n  - 2\n- - 1\n  - 2\n')
+
+    def testRangeAsArgs(self):
+        self.assertEqual(expand({'+': {'range': [1, 4]}}, new_globals()), 10)
+        self.assertEqual(expand({'flatone': {'range': [1, 3]}}, new_globals()), [1, 2, 3])
+        self.assertEqual(expand({'python_eval': 'r + [4]'}, {'r': Range(1, 3)}), [1, 2, 3, 4])
+        self.assertEqual(expand({'python_eval': 'isinstance(r, list) and r.index(2)'}, {'r': Range(1, 3)}), 1)
+        r = Range(5, 2)
+        self.assertEqual((r.index(3), r.count(3), r.count(9)), (2, 1, 0))
+        self.assertEqual([0] + Range(1, 2) + [3], [0, 1, 2, 3])
+
     def test_range_builtin_bad(self):
         with self.assertRaises(Exception) as context:
             range_builtin({ "range:" : None}, None, {})
@@ -689,6 +923,523 @@ class TestYamp(unittest.TestCase):
         with self.assertRaises(Exception) as context:
             range_builtin({ "range:" :[1, "x"]}, [1, "x"], {})
 
+    def testDocumentWriter(self):
+        for stream in [False, True]:
+            out = StringIO.StringIO()
+            writer = DocumentWriter(out, stream)
+            writer.add({'a': 1})
+            writer.close()
+            self.assertEqual(out.getvalue(), 'a: 1\n')
+            out = StringIO.StringIO()
+            writer = DocumentWriter(out, stream)
+            writer.add([1])
+            self.assertEqual(out.getvalue(), '')
+            writer.add([2])
+            self.assertEqual(out.getvalue(), '---\n- 1\n---\n- 2\n' if stream else '')
+            writer.close()
+            self.assertEqual(out.getvalue(), '---\n- 1\n---\n- 2\n')
+
+    def testDocumentEmitter(self):
+        import datetime
+        shared = [1, {'a': 'b'}]
+        docs = [{'a': [1, 2.5, {'b': None}], 'c': 'x\ny', 'd': u'caf\xe9', 1: True, (1, 2): 'tuple', 'e': ''},
+                [shared, [shared, {'s': shared}], [], {}],
+                {'r': Range(1, 3), 'rr': [Range(3, 1), Range(3, 1)], 'long': 'word ' * 40, 'yes': 'null'},
+                [datetime.date(2019, 1, 2), set([1]), (1, 'a'), '\xff\xfe', 10**30]]
+        # Scalar objects other than strings, numbers and booleans are also anchored when they are shared
+        date, pair, big = datetime.date(2019, 1, 2), (1, 'a'), 10**30
+        docs.append([date, [pair, big, {'d': date}], {date: 'key'}, pair, big, 'x', 'x', 1.5, 1.5])
+        try:
+            for backend in sorted(YAML_BACKENDS.keys()):
+                set_yaml_backend(backend)
+                for doc in docs:
+                    out = StringIO.StringIO()
+                    DocumentEmitter(out, yaml_dumper).emit(doc)
+                    self.assertEqual(dump(doc, Dumper=yaml_dumper, default_flow_style=False), out.getvalue())
+        finally:
+            set_yaml_backend()
+
+    def testJsonWriters(self):
+        import datetime
+        docs = [{'b': [1, Range(1, 2)], 'a': None}, 'x', datetime.date(2019, 1, 2)]
+        out = StringIO.StringIO()
+        writer = NdjsonWriter(out)
+        writer.add(docs[0])
+        self.assertEqual(out.getvalue(), '{"a":null,"b":[1,[1,2]]}\n')
+        writer.add(docs[2])
+        writer.close()
+        self.assertEqual(out.getvalue(), '{"a":null,"b":[1,[1,2]]}\n"2019-01-02"\n')
+        out = StringIO.StringIO()
+        writer = JsonWriter(out)
+        writer.add(docs[1])
+        writer.close()
+        self.assertEqual(out.getvalue(), '"x"\n')
+        for stream in [False, True]:
+            out = StringIO.StringIO()
+            writer = JsonWriter(out, stream)
+            for doc in docs:
+                writer.add(doc)
+            writer.close()
+            self.assertEqual(json.loads(out.getvalue()), [{'a': None, 'b': [1, [1, 2]]}, 'x', '2019-01-02'])
+        with self.assertRaisesRegexp(YampException, "Cannot write <type 'set'> as JSON"):
+            NdjsonWriter(StringIO.StringIO()).add([set([1])])
+        with self.assertRaisesRegexp(YampException, 'Cannot write document as JSON'):
+            NdjsonWriter(StringIO.StringIO()).add({(1, 2): 'tuple key'})
+        with self.assertRaisesRegexp(YampException, 'Cannot write document as JSON'):
+            NdjsonWriter(StringIO.StringIO()).add([float('inf')])
+
+    def testStreamOutput(self):
+        source = tempfile.mkstemp(suffix='.yaml')
+        os.write(source[0], 'define: {x: 1}\n---\n- x\n---\n- y: x\n---\n[]\n')
+        os.close(source[0])
+        outputs = []
+        for stream in [False, True]:
+            out = StringIO.StringIO()
+            expand_file(source[1], new_globals([]), expandafterload=True, outputfile=out, stream=stream)
+            outputs.append(out.getvalue())
+        os.remove(source[1])
+        self.assertEqual(outputs[0], '---\n- 1\n---\n- y: 1\n')
+        self.assertEqual(outputs[0], outputs[1])
+        # The top-level file is not parsed ahead, so documents before a syntax error are written
+        source = tempfile.mkstemp(suffix='.yaml')
+        os.write(source[0], '- 1\n---\n- 2\n---\n- [3\n')
+        os.close(source[0])
+        out = StringIO.StringIO()
+        with self.assertRaises(SystemExit):
+            expand_file(source[1], new_globals([]), expandafterload=True, outputfile=out, stream=True)
+        self.assertEqual('---\n- 1\n---\n- 2\n', out.getvalue())
+        self.assertEqual(None, parse_cache.get((source[1], read_yaml_documents)))
+        os.remove(source[1])
+
+    def testExpandDocumentsParallel(self):
+        documents = [{'define': {'x': 1}},
+                     {'defmacro': {'name': 'm', 'args': ['a'], 'value': ['a', 'x']}},
+                     ['x'],
+                     {'define': {'y': 2}},
+                     ['y', {'m': {'a': 'y'}}],
+                     {'k': 'x'},
+                     ['{{x}} {{y}}']]
+        sequential = list(expand_documents(documents, new_globals([]), 1))
+        self.assertEquals([None, None, [1], None, [2, [2, 1]], {'k': 1}, ['1 2']], sequential)
+        self.assertEquals(sequential, list(expand_documents(documents, new_globals([]), 3)))
+        with self.assertRaisesRegexp(YampException, 'Undefined interpolation variable "z"'):
+            list(expand_documents(documents + [['{{z}}'], ['x']], new_globals([]), 3))
+
+    def testBatch(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        def write(name, text):
+            with open(os.path.join(directory, name), 'w') as fd:
+                fd.write(text)
+        def read(name):
+            with open(os.path.join(directory, name)) as fd:
+                return fd.read()
+        write('a.yaml', '- define: {x: 1}\n- "{{x}} {{argv.1}}"\n')
+        write('b.yaml', '- x\n')
+        write('bad.yaml', '- "{{x}}"\n')
+        write('manifest', '# Comment\n\na.yaml:a.out\nb.yaml:b.out\n')
+        pairs = read_manifest(os.path.join(directory, 'manifest'))
+        self.assertEquals([(os.path.join(directory, 'a.yaml'), os.path.join(directory, 'a.out')),
+                           (os.path.join(directory, 'b.yaml'), os.path.join(directory, 'b.out'))], pairs)
+        for jobs in [1, 2]:
+            self.assertEquals(0, expand_batch(pairs, jobs=jobs))
+            self.assertEquals("- 1 {}\n".format(pairs[0][0]), read('a.out'))
+            self.assertEquals("- x\n", read('b.out')) # x is not defined in a new global environment
+        stderr = sys.stderr
+        sys.stderr = StringIO.StringIO()
+        try:
+            self.assertEquals(1, expand_batch([parse_pair('bad.yaml:bad.out', directory)] + pairs, jobs=1))
+        finally:
+            sys.stderr = stderr
+        self.assertEquals("- x\n", read('b.out'))
+        self.assertEquals(('in:x', '-'), parse_pair('in:x:-'))
+        with self.assertRaises(YampException):
+            parse_pair('in.yaml')
+
+    def testDiskCache(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        source = os.path.join(directory, 'data.yaml')
+        with open(source, 'w') as fd:
+            fd.write('a: [1, 2]\n---\nb: 2018-01-01\n')
+        cache = DiskCache(os.path.join(directory, 'cache'))
+        expected = list(read_yaml_documents(open(source)))
+        self.assertEquals(expected, cache.parse(source, read_yaml_documents))
+        self.assertEquals(expected, cache.parse(source, read_yaml_documents))
+        self.assertEquals((1, 1), (cache.hits, cache.misses))
+        with open(source, 'w') as fd:
+            fd.write('a: [1, 2, 3]\n')
+        self.assertEquals([{'a': [1, 2, 3]}], cache.parse(source, read_yaml_documents))
+        self.assertEquals(2, len(cache.entries()))
+        self.assertTrue(cache.stats().endswith('2 entries, {} bytes, 1 hits, 2 misses'.format(
+            sum(os.path.getsize(entry) for entry in cache.entries()))))
+        cache.clear()
+        self.assertEquals([], cache.entries())
+
+    def testDependencies(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        with open(os.path.join(directory, 'sub file.yaml'), 'w') as fd:
+            fd.write('- "{{env.HOME}}"\n')
+        with open(os.path.join(directory, 'main.yaml'), 'w') as fd:
+            fd.write('- include: ["sub file.yaml"]\n- "{{argv.3}}"\n- python_eval: env.get("USER")\n')
+        source, output, depfile = [os.path.join(directory, name) for name in ('main.yaml', 'out.yaml', 'out.d')]
+        options = parse_arguments(['yamp', '--output', output, '--depfile', depfile, source, 'a', 'b'])
+        expand_single_file(options, ['yamp', source, 'a', 'b'])
+        with open(depfile) as fd:
+            self.assertEquals('{}: {} \\\n  {}\n'.format(output.replace(' ', '\\ '), source,
+                                                       os.path.join(directory, 'sub\\ file.yaml')), fd.read())
+        options = parse_arguments(['yamp', '--depfile', depfile, '--depfile-format', 'json', '--output', output, source])
+        expand_single_file(options, ['yamp', source, 'a', 'b'])
+        with open(depfile) as fd:
+            self.assertEquals({'output': output, 'files': [source, os.path.join(directory, 'sub file.yaml')],
+                               'env': ['HOME', 'USER'], 'argv': [3]}, json.load(fd))
+        tracked = Dependencies({'A': 1}, ['x'])
+        tracked.used({'A': 1}, 'A')
+        tracked.used(tracked.argv, '0')
+        tracked.merge(Dependencies({}, []).records())
+        self.assertEquals((set(), set([0]), False), (tracked.env_keys, tracked.argv_indexes, tracked.all_env))
+        tracked.used_all(tracked.env)
+        self.assertTrue(tracked.all_env)
+
+    def testResultCache(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        with open(os.path.join(directory, 'a.yaml'), 'w') as fd:
+            fd.write('- include: [b.yaml]\n- "{{env.WHO}} {{argv.2}}"\n')
+        with open(os.path.join(directory, 'b.yaml'), 'w') as fd:
+            fd.write('- b\n')
+        with open(os.path.join(directory, 'now.yaml'), 'w') as fd:
+            fd.write('- python_eval: datetime.datetime.now().year\n')
+        def run(filename, who='world'):
+            return serve_request({'argv': ['--cache-dir', 'cache', '--cache-results', '--cache-stats', filename, 'x'],
+                                  'cwd': directory, 'env': {'WHO': who}}, 'yamp')
+        self.assertEquals('- b\n- world x\n', run('a.yaml')['output'])
+        self.assertTrue(run('a.yaml')['error'].endswith(' 1 hits, 0 misses\n'))
+        self.assertEquals('- b\n- moon x\n', run('a.yaml', 'moon')['output'])
+        with open(os.path.join(directory, 'b.yaml'), 'w') as fd:
+            fd.write('- c\n')
+        self.assertEquals('- c\n- moon x\n', run('a.yaml', 'moon')['output'])
+        self.assertTrue(run('a.yaml', 'moon')['error'].endswith(' 1 hits, 0 misses\n'))
+        self.assertEquals(run('now.yaml')['output'], run('now.yaml')['output'])
+        self.assertEquals(1, len([entry for entry in DiskCache(os.path.join(directory, 'cache')).entries()
+                                  if entry.endswith('.result')]))
+        serve_request({'argv': ['b.yaml'], 'cwd': directory}, 'yamp')
+
+    def testWatcher(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        def write(name, text):
+            with open(os.path.join(directory, name), 'w') as fd:
+                fd.write(text)
+        def read(name):
+            with open(os.path.join(directory, name)) as fd:
+                return fd.read()
+        write('common.yaml', '- 1\n')
+        write('a.yaml', '- include: [common.yaml]\n- "{{argv.2}}"\n')
+        write('b.yaml', '- b\n')
+        targets = [(os.path.join(directory, name + '.yaml'), os.path.join(directory, name + '.out'), ['yamp', name, 'x'])
+                   for name in ('a', 'b')]
+        watcher = Watcher(targets)
+        self.assertEquals([0, 0], watcher.start())
+        self.assertEquals('- 1\n- x\n', read('a.out'))
+        self.assertEquals([], watcher.poll())
+        write('common.yaml', '- 22\n')
+        self.assertEquals([0], watcher.poll())
+        self.assertEquals('- 22\n- x\n', read('a.out'))
+        write('b.yaml', '- [b\n')
+        self.assertEquals([1], watcher.poll())
+        write('b.yaml', '- c\n')
+        self.assertEquals([1], watcher.poll())
+        self.assertEquals('- c\n', read('b.out'))
+        # A file changed during the expansion which read it is expanded again by the next poll
+        write('d.yaml', '- 1\n')
+        write('c.yaml', '- include: [d.yaml]\n- python_eval: open("{}", "a").write("- 2\\n")\n'.format(
+            os.path.join(directory, 'd.yaml')))
+        watcher = Watcher([(os.path.join(directory, 'c.yaml'), os.path.join(directory, 'c.out'), ['yamp'])])
+        self.assertEquals([0], watcher.start())
+        self.assertEquals([0], watcher.poll())
+        self.assertEquals('- 1\n- 2\n', read('c.out'))
+
+    def testProfiler(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        with open(os.path.join(directory, 'a.yaml'), 'w') as fd:
+            fd.write('- defmacro: {name: twice, args: [x], value: {+: [x, x]}}\n'
+                     '- defmacro: {name: down, args: [n], value: {if: {==: [n, 0]}, then: 0, else: {down: {n: {+: [n, -1]}}}}}\n'
+                     '- repeat: {for: i, in: [1, 2, 3], body: {twice: {x: i}}}\n'
+                     '- down: {n: 4}\n')
+        response = serve_request({'argv': ['--profile', '--profile-format', 'json', '--profile-sort', 'name', 'a.yaml'],
+                                  'cwd': directory}, 'yamp')
+        self.assertEquals('- - 2\n  - 4\n  - 6\n- 0\n', response['output'])
+        report = json.loads(response['error'])
+        rows = dict((row['name'], row) for row in report['macros'])
+        self.assertEquals(sorted(rows.keys()), [row['name'] for row in report['macros']])
+        self.assertEquals(['+', '==', 'defmacro', 'down', 'if', 'repeat', 'twice'], sorted(rows.keys()))
+        self.assertEquals((3, 'macro', 2.0), (rows['twice']['calls'], rows['twice']['kind'], rows['twice']['size']))
+        self.assertEquals((5, 5, 7), (rows['down']['calls'], rows['if']['calls'], rows['+']['calls']))
+        self.assertTrue(rows['repeat']['inclusive'] >= rows['twice']['inclusive'] + rows['repeat']['exclusive'] * 0.99)
+        self.assertTrue(rows['down']['inclusive'] <= report['total'])
+        response = serve_request({'argv': ['--profile', 'a.yaml'], 'cwd': directory}, 'yamp')
+        self.assertTrue(response['error'].startswith('name '))
+        self.assertEquals('apply', new_globals()['repeat'][1].__name__) # Not instrumented after the run
+
+    def testTracer(self):
+        import yamp
+        from fold_trace import fold
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        with open(os.path.join(directory, 'a.yaml'), 'w') as fd:
+            fd.write('- defmacro: {name: twice, args: [x], value: {+: [x, x]}}\n'
+                     '- top: {twice: {x: 2}}\n')
+        events = []
+        set_tracer(events.append)
+        try:
+            output = StringIO.StringIO()
+            yamp.expand_file(os.path.join(directory, 'a.yaml'), new_globals(), outputfile=output)
+        finally:
+            set_tracer(None)
+        self.assertEquals('- top: 4\n', output.getvalue())
+        self.assertTrue(yamp.expand_file is expand_file)
+        filename = os.path.join(directory, 'a.yaml')
+        self.assertEquals({'type': 'file', 'name': filename, 'path': ['@' + filename], 'file': filename, 'depth': 0,
+                           'size': 1}, dict((k, v) for k, v in events[-1].items() if k != 'elapsed'))
+        calls = [event for event in events if event['type'] == 'apply']
+        self.assertEquals([['@' + filename, '0', '0', 'defmacro()'],
+                           ['@' + filename, '0', '1', 'top', 'twice()', '+()'],
+                           ['@' + filename, '0', '1', 'top', 'twice()']], [event['path'] for event in calls])
+        self.assertTrue(all(event['file'] == filename for event in events))
+        self.assertTrue(all(event['depth'] == len(event['path']) - 1 for event in events))
+        self.assertEquals(3, [event['size'] for event in events if event['type'] == 'expand'][-1]) # [{top: 4}]
+        stacks = fold(events)
+        self.assertEquals(['@' + filename, '@{0};defmacro()'.format(filename), '@{0};twice()'.format(filename),
+                           '@{0};twice();+()'.format(filename)], sorted(stacks.keys()))
+        self.assertAlmostEquals(events[-1]['elapsed'] * 1e6, sum(stacks.values()), delta=1)
+
+    def testStackEngine(self):
+        import yamp
+        deep = 'x'
+        for i in range(5000):
+            deep = [{'k': deep}]
+        countdown = load('''
+- defmacro:
+    name: down
+    args: [n]
+    value: {if: {'==': [n, 0]}, then: done, else: {down: {n: {'+': [n, -1]}}}}
+- down: {n: 5000}
+''', Loader=Loader)
+        samples = [load(text, Loader=Loader) for text in [
+            '[{define: {a: 1}}, {define: {b: [x, "{{a}}"]}}, {c: b, "{{a}}": [[1, [2]], {flatten: [[a], [[b]]]}]}]',
+            '[{repeat: {for: i, in: {range: [1, 3]}, body: {"k{{i}}": {if: {"==": [i, 2]}, then: two}}}}]',
+            '[{defmacro: {name: m, args: [x], value: [x, x]}}, {m: {x: 1}}, {quote: "{{y}}"}]',
+            '[{define: {s: t}}, {define: {t: "{{s}}x", u: s}}, [s, u, {k: u}], {if: true, then: {quote: [u, "{{s}}"]}}]',
+            '[{defmacro: {name: f, args: [n], value: {if: true, then: [n, u, {n: s}, {quote: n}]}}}, {f: {n: u}}]',
+        ]]
+        errors = ['{a: 1, "{{b}}": 2}', '[{define: {k: a}}, {a: 1, "{{k}}": 2}]', '{if: true, then: 1, else: 2, x: 3}', '{^: [a, b]}']
+        try:
+            yamp.set_engine('stack')
+            self.assertEquals(['done'], expand(countdown, new_globals()))
+            result = expand(deep, new_globals())
+            for i in range(5000):
+                result = result[0]['k']
+            self.assertEquals('x', result)
+            stack_results = [expand(tree, new_globals()) for tree in samples]
+            stack_errors = [self.engine_error(text) for text in errors]
+        finally:
+            yamp.set_engine('recursive')
+        self.assertEquals([expand(tree, new_globals()) for tree in samples], stack_results)
+        self.assertEquals([self.engine_error(text) for text in errors], stack_errors)
+        self.assertTrue(all(stack_errors))
+        self.assertRaisesRegexp(YampException, 'Unknown engine "fast"', yamp.set_engine, 'fast')
+
+    def testDeepDocumentFile(self):
+        import yamp
+        source = tempfile.mkstemp(suffix='.yaml')
+        os.write(source[0], '- define: {x: 1}\n- ' + '[{k: ' * 3000 + 'x' + '}]' * 3000 + '\n')
+        os.close(source[0])
+        out = StringIO.StringIO()
+        try:
+            yamp.set_engine('stack')
+            expand_file(source[1], new_globals([]), expandafterload=True, outputfile=out)
+        finally:
+            yamp.set_engine('recursive')
+        os.remove(source[1])
+        deep = next(read_yaml_documents(out.getvalue()))[0]
+        self.assertEquals(6001, tree_size(deep))
+        self.assertFalse(uses_forms(deep, IMPURE_FORMS))
+        self.assertTrue(side_effect_free(deep, new_globals([]), set()))
+        self.assertEquals(canonical(deep), canonical(next(read_yaml_documents(out.getvalue()))[0]))
+        for i in range(3000):
+            deep = deep[0]['k']
+        self.assertEquals(1, deep)
+
+    def testTailCalls(self):
+        limit = sys.getrecursionlimit()
+        tree = load('''
+- defmacro:
+    name: down
+    args: [n]
+    value: {if: {'==': [n, 0]}, then: done, else: {down: {n: {'+': [n, -1]}}}}
+- down: {n: 20000}
+''', Loader=Loader)
+        self.assertEquals(['done'], expand(tree, new_globals()))
+        self.assertEquals(limit, sys.getrecursionlimit())
+        # The results are still expanded again at each level
+        tree = load('''
+- define: {x: {quote: "{{z}}"}}
+- define: {z: y, y: 3}
+- defmacro:
+    name: down
+    args: [n]
+    value: {if: {'==': [n, 0]}, then: [x, "{{z}}", {k: x}], else: {down: {n: {'+': [n, -1]}}}}
+- down: {n: 3}
+- defmacro: {name: other, args: [n], value: {if: true, then: {twice: {v: n}}}}
+- defmacro: {name: twice, args: [v], value: [v, v]}
+- other: {n: z}
+''', Loader=Loader)
+        self.assertEquals([[3, 3, {'k': 3}], [3, 3]], expand(tree, new_globals()))
+        # A loop keeps the same number of scopes however many times it goes round
+        import gc
+        import yamp
+        def scopes(tree, args, bindings):
+            return len([o for o in gc.get_objects() if type(o) == yamp.Scope])
+        tree = load('''
+- defmacro:
+    name: down
+    args: [n]
+    value: {if: {'==': [n, 0]}, then: {scopes: null}, else: {down: {n: {'+': [n, -1]}}}}
+- down: {n: 10}
+- down: {n: 1000}
+''', Loader=Loader)
+        g = new_globals()
+        g['scopes'] = ('eager', scopes)
+        few, many = expand(tree, g)
+        self.assertEquals(few, many)
+        import yamp
+        g = new_globals()
+        g['a'] = 1
+        self.assertTrue(settled(['x', {'k': [1, 'y.z']}, 2.0, True], g))
+        for tree in ['a', 'a.b', '{{a}}', [None], {'^a': 1}, {'if': 1}, {'{{a}}': 1}, {'k': ['a']}]:
+            self.assertFalse(settled(tree, g), tree)
+        # Results of quote and python_eval are copied when expanded again, so nothing is written as a YAML alias
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        with open(os.path.join(directory, 'a.yaml'), 'w') as fd:
+            fd.write('''
+- define: {x: {quote: "{{z}}"}, items: [1, 2]}
+- define: {z: y, y: 3}
+- defmacro: {name: q, args: [n], value: {if: true, then: {quote: [a, {b: c}]}}}
+- defmacro: {name: p, args: [n], value: {if: true, then: {python_eval: items}}}
+- [{q: {n: 1}}, {q: {n: 2}}, {p: {n: 1}}, {p: {n: 2}}]
+- repeat: {for: i, in: [1, 2], key: "k{{i}}", body: {python_eval: items}}
+- repeat: {for: i, in: [1, 2], key: "k{{i}}", body: [x, i, "{{z}}"]}
+''')
+        output = StringIO.StringIO()
+        yamp.expand_file(os.path.join(directory, 'a.yaml'), new_globals(), outputfile=output)
+        self.assertEquals([[['a', {'b': 'c'}], ['a', {'b': 'c'}], [1, 2], [1, 2]],
+                           {'k1': [1, 2], 'k2': [1, 2]},
+                           {'k1': [3, 1, 3], 'k2': [3, 2, 3]}], load(output.getvalue(), Loader=Loader))
+        self.assertFalse('&' in output.getvalue())
+
+    def engine_error(self, text):
+        try:
+            expand(load(text, Loader=Loader), new_globals())
+        except YampException as e:
+            return str(e)
+
+    def testServeRequest(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        with open(os.path.join(directory, 'a.yaml'), 'w') as fd:
+            fd.write('- "{{argv.2}} {{env.WHO}}"\n')
+        cwd = os.getcwd()
+        stdout = sys.stdout
+        response = serve_request({'argv': ['a.yaml', 'hello'], 'cwd': directory, 'env': {'WHO': 'world'}}, 'yamp')
+        self.assertEquals({'status': 0, 'output': '- hello world\n', 'error': ''}, response)
+        response = serve_request({'argv': ['-'], 'cwd': directory, 'stdin': '[x, "{{argv.0}}"]'}, 'yamp')
+        self.assertEquals({'status': 0, 'output': '- x\n- yamp\n', 'error': ''}, response)
+        response = serve_request({'argv': ['missing.yaml'], 'cwd': directory}, 'yamp')
+        self.assertEquals(1, response['status'])
+        self.assertTrue(response['error'].startswith('ERROR: ' + os.path.join(directory, 'missing.yaml')))
+        response = serve_request({'argv': ['--server', 'x'], 'cwd': directory}, 'yamp')
+        self.assertEquals(1, response['status'])
+        response = serve_request({'argv': ['--watch', 'a.yaml'], 'cwd': directory}, 'yamp')
+        self.assertEquals({'status': 1, 'output': '', 'error': 'ERROR: --watch cannot be used by a client\n'}, response)
+        # The server's --cache-dir is used by requests which do not give their own
+        import yamp
+        with open(os.path.join(directory, 'b.yaml'), 'w') as fd:
+            fd.write('- include: [a.yaml]\n')
+        yamp.server_disk_cache = DiskCache(os.path.join(directory, 'cache'))
+        try:
+            self.assertEquals(0, serve_request({'argv': ['b.yaml', 'x'], 'cwd': directory, 'env': {'WHO': 'y'}}, 'yamp')['status'])
+            self.assertEquals(1, yamp.server_disk_cache.misses)
+        finally:
+            yamp.server_disk_cache = None
+        self.assertEquals(1, len(DiskCache(os.path.join(directory, 'cache')).entries()))
+        self.assertEquals(cwd, os.getcwd())
+        self.assertTrue(sys.stdout is stdout)
+
+    def testClientFilename(self):
+        import yamp_client
+        self.assertEquals('-', yamp_client.input_filename(['--stream', '-', 'a']))
+        self.assertEquals('f.yaml', yamp_client.input_filename(['f.yaml', '-']))
+        self.assertEquals('f.yaml', yamp_client.input_filename(['--output', '-', '--jobs', '2', 'f.yaml']))
+        self.assertEquals('-x', yamp_client.input_filename(['--', '-x']))
+        self.assertEquals(None, yamp_client.input_filename(['--cache-dir', 'd', '--cache-stats']))
+        self.assertEquals(yamp_client.VALUE_OPTIONS, set(option for action in argument_parser('yamp')._actions
+                                                         for option in action.option_strings if action.nargs != 0))
+
+    def testParseArguments(self):
+        options = parse_arguments(['yamp', '--stream', '--jobs', '4', 'file.yaml', 'a', '--b'])
+        self.assertTrue(options.stream)
+        self.assertEqual(options.jobs, 4)
+        self.assertEqual(options.filename, 'file.yaml')
+        self.assertEqual(options.args, ['a', '--b'])
+        self.assertFalse(parse_arguments(['yamp', 'file.yaml']).stream)
+
+    @unittest.skipUnless('c' in YAML_BACKENDS, 'libyaml is not installed')
+    def testYamlBackendParity(self):
+        import glob
+        files = glob.glob(os.path.join(curr_path, '../examples/*.yaml')) + \
+                glob.glob(os.path.join(curr_path, 'regression/*.yaml')) + \
+                glob.glob(os.path.join(curr_path, 'fixtures/*.yaml')) + [os.path.join(curr_path, 'all-examples.yaml')]
+        try:
+            for path in files:
+                outputs = []
+                for backend in ['python', 'c']:
+                    set_yaml_backend(backend)
+                    documents = list(read_yaml_documents(open(path)))
+                    out = StringIO.StringIO()
+                    writer = DocumentWriter(out)
+                    for doc in documents + [Range(1, 3), 'scalar', None]:
+                        writer.add(doc)
+                    writer.close()
+                    outputs.append((documents, out.getvalue()))
+                self.assertEquals(outputs[0], outputs[1], path)
+            # Strings which the emitters would lay out differently, as keys and values
+            import random
+            random.seed(13)
+            alphabet = [u'a', u' ', u' ', u'\r', u'\n', u'\t', u'\x00', u'\x85', u'\u2028', u'\xe9', u'\ufeff', u':',
+                        u'#', u'-', u"'", u'"', u'\\', u'\x7f', u'\U0001f600', u'\x1b', u'\xa0', u'?', u'[', u'&', u'!']
+            strings = ['a\rb', '', 'k' * 128, 'k' * 129, u'', u'caf\xe9', u'a\rb', 'word \x1b ' * 20, u'word  \t' * 20]
+            for i in range(300):
+                text = u''.join(random.choice(alphabet) for _ in range(random.choice([5, 20, 150])))
+                strings.append(text if i % 3 == 0 else text.encode('utf-8'))
+            for text in strings:
+                outputs = []
+                for backend in ['python', 'c']:
+                    set_yaml_backend(backend)
+                    out = StringIO.StringIO()
+                    writer = DocumentWriter(out)
+                    writer.add({text: [text, {'k': text}]})
+                    writer.close()
+                    outputs.append(out.getvalue())
+                self.assertEquals(outputs[0], outputs[1], repr(text))
+        finally:
+            set_yaml_backend()
+        with self.assertRaises(YampException):
+            set_yaml_backend('fortran')
+
     def runFileRegression(self, file_to_test, fixture):
         tempout = tempfile.mkstemp()
         outputfilestream = open(tempout[1], 'w+')